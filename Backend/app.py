@@ -1,92 +1,329 @@
-from flask import Flask, request, jsonify
-import pandas as pd
-import cv2
-import json
+from flask import Flask, Response, request, jsonify
+import numpy as np
 import os
-from skimage.transform import hough_line, hough_line_peaks
-from fuzzywuzzy import fuzz, process
+import importlib
+import threading
+import time
+import warnings
 from textDetect.image_processor import ImagePreprocessor
 from textDetect.text_extractor2 import TextExtractor
-import matplotlib.pyplot as plt
-import ast
+from textDetect.card_index import CardIndex
+from textDetect.fuzzy_matcher import FuzzyMatcher
+from textDetect.catalog import default_catalog_dir, load_catalog
+from textDetect.micro_batcher import MicroBatcher
+from textDetect.tracing import stage
+from textDetect.metrics import registry
+from textDetect.result_cache import DiskCacheBackend, ResultCache, content_key, perceptual_key, version_key
 
 app = Flask(__name__)
 
+registry.describe('tcgdex_cascade_rows_total', 'Catalog rows left after each stage of the matching cascade.')
+
+# Every traced pipeline stage feeds the latency histograms served on /metrics
+registry.install()
+
 class CardIdentifier:
-    def __init__(self, dataset_path, match_threshold=90):
+    def __init__(self, dataset_path, match_threshold=90, debug=False, moves_chunk_rows=32):
         self.dataset_path = dataset_path
         self.match_threshold = match_threshold
+        self.debug = debug
+        # Shortlisted rows whose moves are scored per call, see match_card
+        self.moves_chunk_rows = moves_chunk_rows
+        self.matcher = FuzzyMatcher(match_threshold)
         self.dataset = self.load_data()
+        # Catalog row of each card id, built on first use by record_by_id
+        self.rows_by_id = None
+        self.rows_by_id_lock = threading.Lock()
 
     def load_data(self):
-        data = pd.read_csv(self.dataset_path)
-        list_dict_fields = ['types', 'subtypes', 'evolvesTo', 'abilities', 'attacks', 'weaknesses', 'retreatCost', 'nationalPokedexNumbers', 'resistances', 'rules']
-        for field in list_dict_fields:
-            data[field] = data[field].apply(lambda x: ast.literal_eval(x) if pd.notna(x) else None)
+        # Memory-mapped catalog compiled from the CSV (compiled on first use)
+        data = load_catalog(self.dataset_path)
+        # Build the name/HP index once so lookups don't scan the whole catalog
+        self.index = CardIndex(data.name.tolist(), data.hp.tolist(), self.match_threshold)
         return data
 
-    def match_text(self, extracted_text, actual_text):
-        if extracted_text and actual_text:
-            match = process.extractOne(extracted_text, [actual_text], scorer=fuzz.partial_ratio, score_cutoff=self.match_threshold)
-            return match is not None
-        return False
-
-    def compare_attacks_abilities(self, ocr_text, card_data):
-        possible_matches = []
-        for attack in card_data['attacks'] if card_data['attacks'] is not None else []:
-            if 'name' in attack and isinstance(attack['name'], str) and self.match_text(ocr_text, attack['name']):
-                possible_matches.append(attack)
-            if 'text' in attack and isinstance(attack['text'], str) and self.match_text(ocr_text, attack['text']):
-                possible_matches.append(attack)
-
-        for ability in card_data['abilities'] if card_data['abilities'] is not None else []:
-            if 'name' in ability and isinstance(ability['name'], str) and self.match_text(ocr_text, ability['name']):
-                possible_matches.append(ability)
-            if 'text' in ability and isinstance(ability['text'], str) and self.match_text(ocr_text, ability['text']):
-                possible_matches.append(ability)
-
-        return possible_matches
-
-    def identify_card(self, image_path):
-        preprocessor = ImagePreprocessor()
-        processed_image, name_region, hp_region, moves_region = preprocessor.isolate_regions(image_path)
-
-        ocr_name = TextExtractor.extract_text_from_name(name_region)
-        ocr_hp = TextExtractor.extract_text_from_hp(hp_region)
-        ocr_moves = TextExtractor.extract_text_from_moves(moves_region)
-
-        ocr_name = TextExtractor.post_process_text(ocr_name)
-        ocr_hp = TextExtractor.post_process_hp_text(ocr_hp)
-
-        for index, card in self.dataset.iterrows():
-            name_match = self.match_text(ocr_name, card['name'])
-            hp_match = self.match_text(ocr_hp, str(card['hp']))
-            matches = self.compare_attacks_abilities(ocr_moves, card)
-            if name_match and hp_match and matches:
-                return card.to_dict()
+    def record_by_id(self, card_id):
+        """ Full record of the catalog card with this id, or None. """
+        if self.rows_by_id is None:
+            with self.rows_by_id_lock:
+                if self.rows_by_id is None:
+                    self.rows_by_id = {self.dataset.record(row).get('id'): row for row in range(len(self.dataset))}
+        row = self.rows_by_id.get(card_id)
+        return self.dataset.record(row) if row is not None else None
+
+    def prepare_card(self, image):
+        # image can be a decoded ndarray, the raw upload bytes or a file path
+        preprocessor = ImagePreprocessor(debug=self.debug)
+        with stage('prepare_card'):
+            processed_image, _, _, _, _ = preprocessor.isolate_regions(image)
+        return processed_image
+
+    def identify_cards(self, card_images):
+        """ OCRs and matches a batch of normalized cards (from prepare_card) together. """
+        results = []
+        for ocr_name, ocr_hp, ocr_moves in TextExtractor.extract_text_from_cards(card_images):
+            ocr_name = TextExtractor.post_process_text(ocr_name)
+            ocr_hp = TextExtractor.post_process_hp_text(ocr_hp)
+            survivors = {}
+            with stage('matching'):
+                results.append(self.match_card(ocr_name, ocr_hp, ocr_moves, survivors))
+            for stage_name, rows in survivors.items():
+                registry.increment('tcgdex_cascade_rows_total', rows, stage=stage_name)
+        return results
+
+    def identify_card(self, image):
+        card_image = self.prepare_card(image)
+        if card_image is None:
+            return None
+        return self.identify_cards([card_image])[0]
+
+    def match_card(self, ocr_name, ocr_hp, ocr_moves, survivors=None):
+        """
+        Matching cascade: name, then HP (both through the index), then moves,
+        each stage only looking at the rows the previous one left. Returns the
+        record of the first matching card in catalog order, or None. survivors,
+        if given, gets the number of rows left after each stage.
+        """
+        survivors = {} if survivors is None else survivors
+        with stage('catalog_scan'):
+            rows = self.index.candidates(ocr_name, ocr_hp, self.matcher, survivors)
+        survivors['moves'] = 0
+        if not rows or not ocr_moves:
+            return None
+
+        # Moves are scored a chunk of rows per call, in catalog order, so the cascade stops at the first chunk with a hit
+        for start in range(0, len(rows), self.moves_chunk_rows):
+            owners, texts = [], []
+            for row in rows[start:start + self.moves_chunk_rows]:
+                row_texts = self.dataset.move_texts(row)
+                owners.extend([row] * len(row_texts))
+                texts.extend(row_texts)
+            hits = np.flatnonzero(self.matcher.match_mask(ocr_moves, texts))
+            if len(hits) > 0:
+                survivors['moves'] = 1
+                # Texts are laid out in catalog order, so the first hit is the first matching card
+                return self.dataset.record(owners[hits[0]])
+        return None
+
+CARD_ATTRIBUTES_PATH = 'PokemonCards/cardAttributes/cardAttributes.csv'
+SET_MODEL_PATHS = ('src/ResNet50/pokemon_card_classifier.pth', 'src/ResNet50/label_encoder.pkl')
+ENERGY_MODEL_PATHS = ('src/ResNet50_Energy/pokemon_card_classifier.pth', 'src/ResNet50_Energy/label_encoder.pkl')
+# Shared-backbone set + energy model, used instead of the two models above when it has been trained
+MULTIHEAD_MODEL_PATHS = ('src/ResNet50_MultiHead/pokemon_card_classifier.pth', 'src/ResNet50_MultiHead/label_encoder.pkl')
+# Embedding index of the reference card images (built by ResNet50/embedding_index.py), and how many neighbours to return
+VISUAL_INDEX_DIR = 'src/ResNet50/visual_index'
+VISUAL_TOP_K = 5
+# When OCR finds no match, the nearest reference card is taken as the match if it is at least this similar
+VISUAL_MATCH_THRESHOLD = float(os.environ.get('TCGDEX_VISUAL_MATCH_THRESHOLD', 0.9))
+# How the set and energy classifiers run: 'eager' PyTorch, or their 'torchscript' or
+# 'onnx' export (written by ResNet50/model_export.py) on the CPU
+CLASSIFIER_RUNTIME = os.environ.get('TCGDEX_CLASSIFIER_RUNTIME', 'eager')
+
+# Concurrent /identify requests are coalesced into batches of up to this many cards,
+# waiting at most this long for a batch to fill up
+BATCH_MAX_SIZE = int(os.environ.get('TCGDEX_BATCH_MAX_SIZE', 8))
+BATCH_MAX_WAIT_MS = float(os.environ.get('TCGDEX_BATCH_MAX_WAIT_MS', 5))
+
+# Identify results are cached by a hash of the upload (and, when enabled, a perceptual hash of the
+# warped card) for CACHE_TTL seconds. With CACHE_DIR set, the workers of a host also share them on disk
+CACHE_MAX_ENTRIES = int(os.environ.get('TCGDEX_CACHE_MAX_ENTRIES', 1024))
+CACHE_TTL = float(os.environ.get('TCGDEX_CACHE_TTL', 3600))
+CACHE_DIR = os.environ.get('TCGDEX_CACHE_DIR')
+CACHE_DISK_MAX_ENTRIES = int(os.environ.get('TCGDEX_CACHE_DISK_MAX_ENTRIES', 100000))
+CACHE_PERCEPTUAL_HASH = os.environ.get('TCGDEX_CACHE_PERCEPTUAL_HASH', '0') == '1'
+
+# Created on first use (or by warmup) so importing the app stays cheap
+identifier = None
+identifier_lock = threading.Lock()
+
+def get_identifier():
+    global identifier
+    if identifier is None:
+        with identifier_lock:
+            if identifier is None:
+                start = time.perf_counter()
+                identifier = CardIdentifier(CARD_ATTRIBUTES_PATH)
+                registry.set_gauge('tcgdex_model_load_seconds', time.perf_counter() - start, model='catalog')
+    return identifier
+
+def get_classifiers():
+    """
+    Classifiers to run on each card: the multi-head model alone if it has been
+    trained, otherwise the set symbol and energy classifiers (None for each one
+    that hasn't been trained).
+    """
+    classifiers = []
+    for module, (model_path, label_encoder_path), options in (('ResNet50_MultiHead.CardClassifier', MULTIHEAD_MODEL_PATHS, {}),
+                                                              ('ResNet50.CardClassifier', SET_MODEL_PATHS, {'runtime': CLASSIFIER_RUNTIME}),
+                                                              ('ResNet50_Energy.CardClassifier', ENERGY_MODEL_PATHS, {'runtime': CLASSIFIER_RUNTIME})):
+        if os.path.exists(model_path) and os.path.exists(label_encoder_path):
+            # Imported here so torch is only loaded when a model is actually there
+            classifier_class = importlib.import_module(module).CardClassifier
+            classifiers.append(classifier_class.shared(model_path, label_encoder_path, **options))
+        else:
+            classifiers.append(None)
+    if classifiers[0] is not None:
+        if CLASSIFIER_RUNTIME != 'eager':
+            # Shown once per process
+            warnings.warn(f"TCGDEX_CLASSIFIER_RUNTIME={CLASSIFIER_RUNTIME} is ignored: the multi-head classifier only runs eager")
+        return [classifiers[0]]
+    return classifiers[1:]
 
+def get_visual_index():
+    """ The visual embedding index, or None if it hasn't been built. """
+    if not os.path.exists(os.path.join(VISUAL_INDEX_DIR, 'meta.json')):
         return None
+    # Imported here so torch is only loaded when the index is actually there
+    from ResNet50.embedding_index import EmbeddingIndex
+    return EmbeddingIndex.shared(VISUAL_INDEX_DIR)
 
-identifier = CardIdentifier('PokemonCards/cardAttributes/cardAttributes.csv')
+def classify_batch(card_images):
+    """ Top (set, probability) pairs and energy (type, probability) pairs per card, None where unavailable. """
+    with stage('classification'):
+        classifiers = get_classifiers()
+        if len(classifiers) == 1:
+            predictions = [prediction or (None, None) for prediction in classifiers[0].predict_batch(card_images)]
+            return [top_sets for top_sets, _ in predictions], [types for _, types in predictions]
+        set_classifier, energy_classifier = classifiers
+        top_sets = set_classifier.predict_batch(card_images) if set_classifier else [None] * len(card_images)
+        types = energy_classifier.predict_batch(card_images) if energy_classifier else [None] * len(card_images)
+        return top_sets, types
+
+def identify_batch(card_images):
+    """
+    Runs OCR, matching and classification over a batch of normalized cards.
+    Cards the text matching misses fall back to their nearest reference card
+    by appearance. Every result has a match_source: 'text', 'visual', or None
+    for a card that is still unidentified, which only carries its visual
+    matches.
+    """
+    identifier = get_identifier()
+    results = [dict(result, match_source='text') if result is not None else None
+               for result in identifier.identify_cards(card_images)]
+    predicted_sets, predicted_types = classify_batch(card_images)
+    visual_index = get_visual_index()
+    if visual_index is not None:
+        with stage('visual_lookup'):
+            visual_matches = visual_index.lookup(card_images, top_k=VISUAL_TOP_K)
+    else:
+        visual_matches = [None] * len(card_images)
+    for i, (top_sets, types, neighbours) in enumerate(zip(predicted_sets, predicted_types, visual_matches)):
+        if results[i] is None:
+            # OCR couldn't read or match the card, the visual index still can
+            record = identifier.record_by_id(neighbours[0][0]) if neighbours and neighbours[0][1] >= VISUAL_MATCH_THRESHOLD else None
+            results[i] = dict(record, match_source='visual') if record is not None else {'match_source': None}
+        result = results[i]
+        # Most likely set with its probability, and every energy type that cleared the threshold
+        result['predicted_set'], result['predicted_set_probability'] = top_sets[0] if top_sets else (None, None)
+        result['predicted_types'] = [energy_type for energy_type, _ in types] if types else None
+        # Nearest reference cards by appearance, most similar first
+        result['visual_matches'] = [{'id': card_id, 'similarity': similarity} for card_id, similarity in neighbours] if neighbours else None
+    return results
+
+batcher = None
+batcher_lock = threading.Lock()
+
+result_cache = None
+result_cache_lock = threading.Lock()
+
+def cache_version():
+    # Cached results depend on the compiled catalog, the models and how the classifiers run
+    paths = [os.path.join(default_catalog_dir(CARD_ATTRIBUTES_PATH), 'meta.json'), os.path.join(VISUAL_INDEX_DIR, 'meta.json')]
+    paths += SET_MODEL_PATHS + ENERGY_MODEL_PATHS + MULTIHEAD_MODEL_PATHS
+    return version_key(paths, CLASSIFIER_RUNTIME, VISUAL_TOP_K, VISUAL_MATCH_THRESHOLD)
+
+def get_result_cache():
+    global result_cache
+    if result_cache is None:
+        with result_cache_lock:
+            if result_cache is None:
+                disk = DiskCacheBackend(CACHE_DIR, CACHE_DISK_MAX_ENTRIES, CACHE_TTL) if CACHE_DIR else None
+                result_cache = ResultCache(CACHE_MAX_ENTRIES, CACHE_TTL, disk, cache_version())
+    return result_cache
+
+def get_batcher():
+    global batcher
+    if batcher is None:
+        with batcher_lock:
+            if batcher is None:
+                batcher = MicroBatcher(identify_batch, max_batch=BATCH_MAX_SIZE, max_wait=BATCH_MAX_WAIT_MS / 1000)
+    return batcher
+
+def warmup():
+    """ Loads the card catalog, the OCR reader and the classifiers up front. Returns the load time of each in seconds. """
+    timings = {}
+    start = time.perf_counter()
+    get_identifier()
+    timings['catalog'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    TextExtractor.warmup()
+    timings['ocr_reader'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for classifier in get_classifiers():
+        if classifier is not None:
+            classifier.warmup()
+    timings['classifiers'] = time.perf_counter() - start
+
+    visual_index = get_visual_index()
+    if visual_index is not None:
+        start = time.perf_counter()
+        visual_index.ensure_embedder()
+        timings['visual_index'] = time.perf_counter() - start
+    return timings
+
+@app.route('/warmup', methods=['POST'])
+def warmup_route():
+    return jsonify({'status': 'ready', 'load_seconds': warmup()})
 
 @app.route('/identify', methods=['POST'])
 def identify():
     if 'image' not in request.files:
+        registry.increment('tcgdex_identify_total', result='bad_request')
         return jsonify({'error': 'No image file provided'}), 400
 
-    image_file = request.files['image']
-    image_path = os.path.join('temp', image_file.filename)
-    image_file.save(image_path)
+    with stage('identify_request'):
+        # Decode straight from the request buffer, nothing touches the disk
+        with stage('upload_read'):
+            image_bytes = request.files['image'].read()
+
+        # The same photo submitted again skips the whole pipeline
+        cache = get_result_cache()
+        keys = [content_key(image_bytes)]
+        hit, result = cache.get(keys[0])
+        if not hit:
+            try:
+                card_image = get_identifier().prepare_card(image_bytes)
+            except ValueError as e:
+                registry.increment('tcgdex_identify_total', result='bad_request')
+                return jsonify({'error': str(e)}), 400
 
-    result = identifier.identify_card(image_path)
-    os.remove(image_path)
+            if card_image is not None and CACHE_PERCEPTUAL_HASH:
+                # A re-encoded or slightly different shot of the same card still hits after the warp
+                keys.append(perceptual_key(card_image))
+                hit, result = cache.get(keys[1])
+            if not hit:
+                # OCR and classification run batched with whatever other requests are in flight
+                with stage('batched_identify'):
+                    result = get_batcher().submit(card_image) if card_image is not None else None
+            # Misses aren't cached: a clearer shot of the same card should get its chance
+            if result is not None and result['match_source'] is not None:
+                cache.put(keys, result)
 
-    if result:
+    if result is not None and result['match_source'] is not None:
+        registry.increment('tcgdex_identify_total', result='match' if result['match_source'] == 'text' else 'visual_match')
         return jsonify(result)
     else:
-        return jsonify({'error': 'Card not identified'}), 404
+        registry.increment('tcgdex_identify_total', result='miss')
+        # The closest cards by appearance, if any, so the client can offer them
+        visual_matches = result['visual_matches'] if result is not None else None
+        return jsonify({'error': 'Card not identified', 'visual_matches': visual_matches}), 404
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """ Stage latency histograms, identify counters and model load times in the Prometheus text format. """
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
 
 if __name__ == '__main__':
-    if not os.path.exists('temp'):
-        os.makedirs('temp')
     app.run(host='0.0.0.0', port=5000)
@@ -0,0 +1,107 @@
+import argparse
+import random
+import string
+import sys
+
+from rapidfuzz import fuzz, utils
+
+from benchmarks.synthetic import synthetic_cards
+from textDetect.card_index import CardIndex
+from textDetect.fuzzy_matcher import FuzzyMatcher
+
+DEFAULT_THRESHOLDS = [50, 60, 70, 75, 80, 85, 90, 95, 100]
+
+
+def scan_candidates(names, hps, ocr_name, ocr_hp, matcher):
+    """ The linear scan CardIndex replaces: every row whose name and HP both match, in catalog order. """
+    if not ocr_name or not ocr_hp:
+        return []
+    name_hits = matcher.match_mask(ocr_name, names)
+    hp_hits = matcher.match_mask(ocr_hp, [str(hp) for hp in hps])
+    return [row for row in range(len(names)) if name_hits[row] and hp_hits[row]]
+
+
+def mutate(text, rng):
+    # One OCR-like error: a character substituted, dropped or inserted
+    alphabet = string.ascii_lowercase + ' '
+    i = rng.randrange(len(text) + 1)
+    edit = rng.choice(('substitute', 'delete', 'insert')) if text else 'insert'
+    if edit == 'substitute' and i < len(text):
+        return text[:i] + rng.choice(alphabet) + text[i + 1:]
+    if edit == 'delete' and i < len(text):
+        return text[:i] + text[i + 1:]
+    return text[:i] + rng.choice(alphabet) + text[i:]
+
+
+def boundary_queries(name, threshold, rng, max_edits=12):
+    """
+    Mutates name one edit at a time and returns the last variant that still
+    reaches threshold and the first one that doesn't: the queries where the
+    n-gram lower bound of the index is tightest.
+    """
+    query = name
+    for _ in range(max_edits):
+        mutated = mutate(query, rng)
+        if fuzz.partial_ratio(mutated, name, processor=utils.default_process) < threshold:
+            return [query, mutated]
+        query = mutated
+    return [query]
+
+
+def name_queries(name, other_name, threshold, rng):
+    if not isinstance(name, str) or not name:
+        return []
+    queries = [name, name.upper(), name[:max(len(name) // 2, 1)], f"{name} ex", f"{other_name} {name}"]
+    return queries + boundary_queries(name, threshold, rng)
+
+
+def check_index(names, hps, thresholds, samples, seed=0):
+    """
+    Compares CardIndex.candidates with the linear scan at each threshold, for
+    names of sampled catalog rows and variants of them. Returns the number of
+    queries checked and the mismatches as (threshold, name, hp, index rows,
+    scan rows).
+    """
+    rng = random.Random(seed)
+    rows = rng.sample(range(len(names)), min(samples, len(names)))
+    checked, mismatches = 0, []
+    for threshold in thresholds:
+        index = CardIndex(names, hps, threshold)
+        matcher = FuzzyMatcher(threshold)
+        for row in rows:
+            other_name = names[rng.randrange(len(names))]
+            hp = str(hps[row])
+            for ocr_name in name_queries(names[row], other_name, threshold, rng):
+                for ocr_hp in (hp, mutate(hp, rng)):
+                    expected = scan_candidates(names, hps, ocr_name, ocr_hp, matcher)
+                    actual = index.candidates(ocr_name, ocr_hp, matcher)
+                    checked += 1
+                    if actual != expected:
+                        mismatches.append((threshold, ocr_name, ocr_hp, actual, expected))
+    return checked, mismatches
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check that CardIndex returns the same candidates as a linear scan of the catalog.')
+    parser.add_argument('--catalog', default=None, help='cardAttributes.csv to check against, a synthetic catalog by default')
+    parser.add_argument('--synthetic-size', type=int, default=5000)
+    parser.add_argument('--samples', type=int, default=200, help='Catalog rows whose names are turned into queries')
+    parser.add_argument('--thresholds', type=int, nargs='+', default=DEFAULT_THRESHOLDS)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.catalog:
+        from textDetect.catalog import load_catalog
+        catalog = load_catalog(args.catalog)
+        # The same columns CardIdentifier indexes
+        names, hps = catalog.name.tolist(), catalog.hp.tolist()
+    else:
+        cards = synthetic_cards(args.synthetic_size, args.seed)
+        names, hps = [card['name'] for card in cards], [card['hp'] for card in cards]
+
+    checked, mismatches = check_index(names, hps, args.thresholds, args.samples, args.seed)
+    for threshold, ocr_name, ocr_hp, actual, expected in mismatches[:20]:
+        print(f"threshold {threshold}: {ocr_name!r} / {ocr_hp!r}: index {actual}, scan {expected}")
+    print(f"{checked - len(mismatches)} of {checked} queries matched the linear scan")
+    if mismatches:
+        sys.exit(1)
@@ -0,0 +1,232 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.synthetic import TYPES, photograph_card, render_card, synthetic_cards, write_catalog_csv
+
+DEFAULT_BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+
+def measure(fn, items, repeat, warmup):
+    """ Runs fn warmup + repeat times and summarizes the seconds per item of the timed runs. """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) / items)
+    times = np.asarray(times)
+    return {
+        'repeat': repeat,
+        'items': items,
+        'median': float(np.median(times)),
+        'p95': float(np.percentile(times, 95)),
+        'min': float(times.min()),
+        'mean': float(times.mean()),
+    }
+
+
+class BenchmarkContext:
+    """ Synthetic catalogs and card images shared by the benchmarks, generated once into work_dir. """
+
+    def __init__(self, work_dir, catalog_sizes, num_images, seed=0):
+        self.work_dir = work_dir
+        self.catalog_sizes = sorted(catalog_sizes)
+        self.cards = synthetic_cards(max(max(self.catalog_sizes), num_images), seed)
+        # Every catalog is a prefix of the largest one, so the imaged cards are in all of them
+        self.catalog_paths = {size: write_catalog_csv(os.path.join(work_dir, f"catalog_{size}.csv"), self.cards[:size])
+                              for size in self.catalog_sizes}
+        self.card_images = [render_card(card) for card in self.cards[:num_images]]
+        self.photos = [photograph_card(image, seed + i) for i, image in enumerate(self.card_images)]
+        self.identifiers = {}
+
+    def identifier(self, size):
+        if size not in self.identifiers:
+            from app import CardIdentifier
+            self.identifiers[size] = CardIdentifier(self.catalog_paths[size])
+        return self.identifiers[size]
+
+
+def bench_preprocessing(context):
+    from textDetect.image_processor import ImagePreprocessor
+    preprocessor = ImagePreprocessor()
+    yield 'preprocess.isolate_regions', lambda: [preprocessor.isolate_regions(photo) for photo in context.photos], len(context.photos)
+
+
+def bench_ocr(context):
+    from textDetect.image_processor import ImagePreprocessor
+    from textDetect.text_extractor2 import TextExtractor
+    TextExtractor.warmup()
+    regions = [ImagePreprocessor().isolate_regions(image) for image in context.card_images]
+    cards = [card for card, _, _, _, _ in regions]
+    n = len(regions)
+    yield 'ocr.extract_text_from_name', lambda: [TextExtractor.extract_text_from_name(r[1]) for r in regions], n
+    yield 'ocr.extract_text_from_hp', lambda: [TextExtractor.extract_text_from_hp(r[2]) for r in regions], n
+    yield 'ocr.extract_text_from_moves', lambda: [TextExtractor.extract_text_from_moves(r[3]) for r in regions], n
+    yield 'ocr.extract_text_from_card', lambda: [TextExtractor.extract_text_from_card(card) for card in cards], n
+    yield 'ocr.extract_text_from_cards', lambda: TextExtractor.extract_text_from_cards(cards), n
+
+
+def bench_matching(context):
+    # The OCR output a perfect read of each imaged card would give
+    queries = [(card['name'], str(card['hp']), card['attacks'][0]['text']) for card in context.cards[:len(context.card_images)]]
+    for size in context.catalog_sizes:
+        identifier = context.identifier(size)
+        yield f"match.match_card[catalog={size}]", lambda identifier=identifier: [identifier.match_card(*query) for query in queries], len(queries)
+
+
+def bench_identify_card(context):
+    size = context.catalog_sizes[0]
+    identifier = context.identifier(size)
+    yield f"identify.identify_card[catalog={size}]", lambda: [identifier.identify_card(photo) for photo in context.photos], len(context.photos)
+
+
+def save_random_classifier(path, encoder_path, num_classes, encoder):
+    # Untrained weights are as fast as trained ones, and need no download
+    import joblib
+    import torch
+    import torch.nn as nn
+    from torchvision.models import resnet50
+    model = resnet50(weights=None)
+    model.fc = nn.Linear(model.fc.in_features, num_classes)
+    torch.save(model.state_dict(), path)
+    joblib.dump(encoder, encoder_path)
+
+
+def bench_classifiers(context):
+    from sklearn.preprocessing import LabelEncoder, MultiLabelBinarizer
+    from ResNet50.CardClassifier import CardClassifier as SetClassifier
+    from ResNet50_Energy.CardClassifier import CardClassifier as EnergyClassifier
+    from ResNet50.model_export import export_classifier
+
+    set_encoder = LabelEncoder().fit(sorted({card['set'] for card in context.cards}))
+    type_encoder = MultiLabelBinarizer().fit([TYPES])
+    for name, classifier_class, encoder, num_classes in (('set', SetClassifier, set_encoder, len(set_encoder.classes_)),
+                                                         ('energy', EnergyClassifier, type_encoder, len(TYPES))):
+        model_path = os.path.join(context.work_dir, f"{name}_classifier.pth")
+        encoder_path = os.path.join(context.work_dir, f"{name}_label_encoder.pkl")
+        save_random_classifier(model_path, encoder_path, num_classes, encoder)
+        classifier = classifier_class(model_path, encoder_path)
+        classifier.warmup()
+        images = context.card_images
+        yield f"classify.{name}.predict", lambda classifier=classifier: [classifier.predict(image) for image in images], len(images)
+        yield f"classify.{name}.predict_batch", lambda classifier=classifier: classifier.predict_batch(images), len(images)
+
+        # The exported graphs of the same weights, see ResNet50/model_export.py
+        for runtime in ('torchscript', 'onnx'):
+            try:
+                export_classifier(classifier, [runtime], check=False)
+                exported = classifier_class(model_path, encoder_path, runtime=runtime)
+                exported.warmup()
+            except Exception as e:
+                print(f"classify.{name}.{runtime} skipped: {type(e).__name__}: {e}")
+                continue
+            yield f"classify.{name}.{runtime}.predict_batch", lambda exported=exported: exported.predict_batch(images), len(images)
+
+
+BENCHMARKS = [bench_preprocessing, bench_ocr, bench_matching, bench_identify_card, bench_classifiers]
+
+
+def run_benchmarks(context, repeat=5, warmup=1, only=None):
+    """
+    Runs every benchmark case whose name contains `only` (all by default).
+    A group whose setup fails, e.g. because the OCR weights aren't cached on
+    this machine, is recorded as skipped with the reason.
+    """
+    results = {}
+    for benchmark in BENCHMARKS:
+        try:
+            for name, fn, items in benchmark(context):
+                if only and only not in name:
+                    continue
+                print(f"{name} ...", end=' ', flush=True)
+                results[name] = measure(fn, items, repeat, warmup)
+                print(f"{1000 * results[name]['median']:.2f} ms/item")
+        except Exception as e:
+            results[benchmark.__name__] = {'skipped': f"{type(e).__name__}: {e}"}
+            print(f"{benchmark.__name__} skipped: {results[benchmark.__name__]['skipped']}")
+    return results
+
+
+def compare_to_baseline(results, baseline, threshold):
+    """
+    Annotates results with their change against the baseline medians and
+    returns the names of the cases that got slower by more than threshold.
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline['results'].get(name, {})
+        if 'median' not in result or 'median' not in base:
+            continue
+        result['baseline_median'] = base['median']
+        result['change'] = result['median'] / base['median'] - 1
+        if result['change'] > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def environment():
+    info = {'python': platform.python_version(), 'platform': platform.platform(), 'machine': platform.machine(), 'cpus': os.cpu_count()}
+    if 'torch' in sys.modules:
+        info['torch'] = sys.modules['torch'].__version__
+        info['torch_threads'] = sys.modules['torch'].get_num_threads()
+    return info
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline benchmarks of the card identification pipeline on synthetic data.')
+    parser.add_argument('--catalog-sizes', type=int, nargs='+', default=[1000, 5000, 20000])
+    parser.add_argument('--images', type=int, default=8, help='Synthetic card images per benchmark')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', default=None, help='Only run the cases whose name contains this')
+    parser.add_argument('--output', default=None, help='Write the results as JSON here')
+    parser.add_argument('--save-baseline', nargs='?', const=DEFAULT_BASELINE_PATH, default=None, metavar='PATH',
+                        help='Save the results as the baseline to compare later runs against')
+    parser.add_argument('--compare', nargs='?', const=DEFAULT_BASELINE_PATH, default=None, metavar='PATH',
+                        help='Compare against a saved baseline and exit with status 1 on a regression')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Slowdown of the median, relative to the baseline, that counts as a regression')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='tcgdex-bench-') as work_dir:
+        context = BenchmarkContext(work_dir, args.catalog_sizes, args.images, args.seed)
+        results = run_benchmarks(context, args.repeat, args.warmup, args.only)
+
+    report = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'environment': environment(),
+        'config': {'catalog_sizes': args.catalog_sizes, 'images': args.images, 'repeat': args.repeat, 'seed': args.seed},
+        'results': results,
+    }
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        regressions = compare_to_baseline(results, baseline, args.threshold)
+        report['baseline'] = {'path': args.compare, 'created': baseline.get('created'), 'threshold': args.threshold}
+        report['regressions'] = regressions
+        for name, result in results.items():
+            if 'change' in result:
+                flag = '  REGRESSION' if name in regressions else ''
+                print(f"{name:<45} {100 * result['change']:+7.1f}% vs baseline{flag}")
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as file:
+                json.dump(report, file, indent=2)
+            print(f"Results written to {path}")
+
+    if regressions:
+        print(f"{len(regressions)} regression(s) beyond {100 * args.threshold:.0f}%: {', '.join(regressions)}")
+        sys.exit(1)
@@ -0,0 +1,97 @@
+import csv
+import random
+
+import cv2
+import numpy as np
+
+from textDetect.catalog import LIST_DICT_FIELDS
+from textDetect.constants import card_size
+
+SYLLABLES = ['pi', 'ka', 'chu', 'bul', 'ba', 'saur', 'char', 'man', 'der', 'squir', 'tle', 'mew', 'two', 'eev', 'ee',
+             'gen', 'gar', 'ony', 'x', 'drag', 'o', 'nite', 'lu', 'gi', 'ho', 'oh', 'ray', 'quaz', 'zap', 'dos']
+WORDS = ['energy', 'damage', 'opponent', 'active', 'pokemon', 'flip', 'coin', 'heads', 'tails', 'discard', 'attach',
+         'bench', 'card', 'hand', 'deck', 'turn', 'attack', 'does', 'more', 'each', 'your', 'this', 'during', 'next']
+TYPES = ['Colorless', 'Darkness', 'Dragon', 'Fairy', 'Fighting', 'Fire', 'Grass', 'Lightning', 'Metal', 'Psychic', 'Water']
+
+
+def synthetic_name(rng):
+    return ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))).capitalize()
+
+
+def synthetic_sentence(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize() + '.'
+
+
+def synthetic_cards(size, seed=0):
+    """ Deterministic catalog rows shaped like cardAttributes.csv. """
+    rng = random.Random(seed)
+    cards = []
+    for i in range(size):
+        attacks = [{'name': synthetic_name(rng) + ' ' + rng.choice(WORDS).capitalize(),
+                    'cost': ['Colorless'] * rng.randint(1, 3),
+                    'damage': str(10 * rng.randint(1, 12)),
+                    'text': synthetic_sentence(rng, rng.randint(6, 18))}
+                   for _ in range(rng.randint(1, 2))]
+        abilities = [{'name': synthetic_name(rng), 'text': synthetic_sentence(rng, rng.randint(8, 20)), 'type': 'Ability'}] if rng.random() < 0.3 else None
+        cards.append({
+            'id': f"syn{i // 200}-{i % 200 + 1}",
+            'name': synthetic_name(rng),
+            'supertype': 'Pokémon',
+            'hp': 10 * rng.randint(3, 33),
+            'set': f"Synthetic Set {i // 200}",
+            'types': rng.sample(TYPES, rng.randint(1, 2)),
+            'attacks': attacks,
+            'abilities': abilities,
+        })
+    return cards
+
+
+def write_catalog_csv(path, cards):
+    """ Writes cards as a cardAttributes.csv, list/dict columns as Python literals. """
+    columns = ['id', 'name', 'supertype', 'hp', 'set'] + LIST_DICT_FIELDS
+    with open(path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=columns)
+        writer.writeheader()
+        for card in cards:
+            writer.writerow({column: repr(card[column]) if column in LIST_DICT_FIELDS and card.get(column) is not None
+                             else card.get(column, '') for column in columns})
+    return path
+
+
+def render_card(card):
+    """ A normalized 600x825 card with the name, HP and moves where the real layout has them. """
+    width, height = card_size
+    image = np.full((height, width, 3), 235, dtype=np.uint8)
+    cv2.rectangle(image, (0, 0), (width - 1, height - 1), (120, 215, 245), 12)
+    cv2.putText(image, card['name'], (20, 60), cv2.FONT_HERSHEY_DUPLEX, 1.3, (20, 20, 20), 2, cv2.LINE_AA)
+    cv2.putText(image, f"HP {card['hp']}", (430, 60), cv2.FONT_HERSHEY_DUPLEX, 1.1, (20, 20, 20), 2, cv2.LINE_AA)
+    cv2.rectangle(image, (40, 100), (560, 400), (150, 120, 90), -1)
+
+    y = 460
+    for move in (card['abilities'] or []) + card['attacks']:
+        cv2.putText(image, move['name'], (20, y), cv2.FONT_HERSHEY_DUPLEX, 0.9, (20, 20, 20), 2, cv2.LINE_AA)
+        y += 34
+        text = move['text']
+        # Wrap the move text to the card width
+        while text and y < 720:
+            line, text = text[:48], text[48:]
+            cv2.putText(image, line, (20, y), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (40, 40, 40), 1, cv2.LINE_AA)
+            y += 26
+        y += 14
+    return image
+
+
+def photograph_card(card_image, seed=0, canvas_size=(1200, 1600)):
+    """
+    Places a rendered card on a dark background with a small random
+    perspective tilt, like a phone photo of a card on a table.
+    """
+    rng = np.random.default_rng(seed)
+    height, width = card_image.shape[:2]
+    canvas_width, canvas_height = canvas_size
+    left, top = (canvas_width - width) / 2, (canvas_height - height) / 2
+    src = np.float32([[0, 0], [width - 1, 0], [width - 1, height - 1], [0, height - 1]])
+    dst = np.float32([[left, top], [left + width, top], [left + width, top + height], [left, top + height]])
+    dst += rng.uniform(-25, 25, size=dst.shape).astype(np.float32)
+    transform = cv2.getPerspectiveTransform(src, dst)
+    return cv2.warpPerspective(card_image, transform, (canvas_width, canvas_height), borderValue=(45, 40, 35))
@@ -0,0 +1,145 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import numpy as np
+
+from textDetect.manifest import iter_manifest
+from textDetect.tracing import record_stages
+
+DEFAULT_CARD_ATTRIBUTES_PATH = 'PokemonCards/cardAttributes/cardAttributes.csv'
+DEFAULT_MANIFEST_PATH = 'PokemonCards/downloaded_images/dataset.jsonl'
+
+# Set up once in each worker process by init_worker
+worker_identifier = None
+
+
+def init_worker(card_attributes_path, match_threshold, threads_per_worker):
+    """ Gives the worker its own CardIdentifier and OCR reader, loaded before it takes any image. """
+    global worker_identifier
+    # Imported here so the parent process never loads torch or the OCR weights
+    import torch
+    from app import CardIdentifier
+    from textDetect.text_extractor2 import TextExtractor
+
+    # Several workers share the cores, so each one keeps to a few threads
+    torch.set_num_threads(threads_per_worker)
+    worker_identifier = CardIdentifier(card_attributes_path, match_threshold)
+    TextExtractor.warmup()
+
+
+def evaluate_entry(entry):
+    started = time.time()
+    start = time.perf_counter()
+    predicted_id = error = None
+    with record_stages() as stages:
+        try:
+            card = worker_identifier.identify_card(entry['image_path'])
+            predicted_id = card['id'] if card else None
+        except Exception as e:
+            # An unreadable image or a card the edge detection can't find counts as a miss, not a crash
+            error = f"{type(e).__name__}: {e}"
+    return {
+        'id': entry['id'],
+        'image_path': entry['image_path'],
+        'predicted_id': predicted_id,
+        'correct': predicted_id is not None and str(predicted_id) == str(entry['id']),
+        'latency': time.perf_counter() - start,
+        'stages': stages,
+        'error': error,
+        'started': started,
+        'finished': time.time(),
+    }
+
+
+def latency_summary(values):
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return None
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {'count': len(values), 'mean': float(values.mean()), 'p50': float(p50), 'p95': float(p95), 'p99': float(p99), 'max': float(values.max())}
+
+
+def build_report(results, workers, startup_seconds):
+    """ Accuracy, latency percentiles per stage and throughput of an evaluation run. """
+    total = len(results)
+    identified = sum(result['predicted_id'] is not None for result in results)
+    correct = sum(result['correct'] for result in results)
+    # Measured from the first image started to the last one finished, so worker startup isn't counted
+    busy_seconds = max(r['finished'] for r in results) - min(r['started'] for r in results) if results else 0.0
+
+    stage_latencies = {}
+    for result in results:
+        for name, seconds in result['stages'].items():
+            stage_latencies.setdefault(name, []).append(seconds)
+
+    return {
+        'images': total,
+        'identified': identified,
+        'correct': correct,
+        'errors': sum(result['error'] is not None for result in results),
+        'accuracy': correct / total if total else None,
+        'identified_rate': identified / total if total else None,
+        'workers': workers,
+        'startup_seconds': startup_seconds,
+        'busy_seconds': busy_seconds,
+        'throughput_images_per_second': total / busy_seconds if busy_seconds > 0 else None,
+        'latency_seconds': {
+            'total': latency_summary([result['latency'] for result in results]),
+            'stages': {name: latency_summary(values) for name, values in sorted(stage_latencies.items())},
+        },
+    }
+
+
+def evaluate(manifest_path, card_attributes_path=DEFAULT_CARD_ATTRIBUTES_PATH, max_images=None, workers=None,
+             threads_per_worker=1, match_threshold=90):
+    """
+    Identifies every image of the manifest on a process pool and returns the
+    report with the per-image results.
+    """
+    workers = workers or os.cpu_count()
+    entries = list(islice(iter_manifest(manifest_path), max_images))
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(card_attributes_path, match_threshold, threads_per_worker)) as executor:
+        results = list(executor.map(evaluate_entry, entries))
+    startup_seconds = min(r['started'] for r in results) - start if results else 0.0
+    return build_report(results, workers, startup_seconds), results
+
+
+def print_summary(report):
+    print(f"Images: {report['images']}, identified: {report['identified']}, correct: {report['correct']}, errors: {report['errors']}")
+    if report['accuracy'] is not None:
+        print(f"Accuracy: {100 * report['accuracy']:.2f}%")
+    if report['throughput_images_per_second'] is not None:
+        print(f"Throughput: {report['throughput_images_per_second']:.2f} images/sec on {report['workers']} workers")
+    rows = [('total', report['latency_seconds']['total'])] + list(report['latency_seconds']['stages'].items())
+    for name, summary in rows:
+        if summary:
+            print(f"  {name:<16} p50 {1000 * summary['p50']:8.1f} ms  p95 {1000 * summary['p95']:8.1f} ms  p99 {1000 * summary['p99']:8.1f} ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the accuracy and per-stage latency of card identification.')
+    parser.add_argument('--manifest', default=DEFAULT_MANIFEST_PATH, help='Dataset manifest of the images to identify')
+    parser.add_argument('--card-attributes', default=DEFAULT_CARD_ATTRIBUTES_PATH)
+    parser.add_argument('--max-images', type=int, default=None)
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes, defaults to the number of cores')
+    parser.add_argument('--threads-per-worker', type=int, default=1, help='Torch threads in each worker')
+    parser.add_argument('--match-threshold', type=int, default=90)
+    parser.add_argument('--output', default=None, help='Write the JSON report here')
+    parser.add_argument('--per-image', action='store_true', help='Include the result of every image in the report')
+    args = parser.parse_args()
+
+    report, results = evaluate(args.manifest, args.card_attributes, args.max_images, args.workers,
+                               args.threads_per_worker, args.match_threshold)
+    if args.per_image:
+        report['results'] = results
+    print_summary(report)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f"Report written to {args.output}")
@@ -0,0 +1,174 @@
+import argparse
+import gc
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+# Production launcher: every worker serves with waitress on the socket the
+# master listens on. Set TCGDEX_CACHE_DIR so the workers also share cached
+# results, each one has its own in-memory cache and micro-batcher
+
+# A CUDA context doesn't survive a fork, so the forked workers serve on the CPU
+os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+import torch
+from waitress import serve
+
+import app as backend
+from textDetect.metrics import registry
+from textDetect.text_extractor2 import TextExtractor
+
+
+def loaded_models():
+    """ The torch modules warmup() loaded: classifiers, the EasyOCR networks and the visual embedder. """
+    models = [classifier.model for classifier in backend.get_classifiers() if classifier is not None]
+    if TextExtractor.reader is not None:
+        models += [TextExtractor.reader.detector, TextExtractor.reader.recognizer]
+    visual_index = backend.get_visual_index()
+    if visual_index is not None and visual_index.embedder is not None:
+        models.append(visual_index.embedder.backbone)
+    # An ONNX Runtime session (see ResNet50/model_export.py) has no autograd state to freeze
+    return [model for model in models if isinstance(model, torch.nn.Module)]
+
+
+def freeze_model(model):
+    # Inference only: no autograd state is ever attached to the weights, so
+    # the workers only read the pages they inherit
+    model.eval()
+    model.requires_grad_(False)
+
+
+def load_shared_state():
+    """
+    Loads the catalog, the OCR reader, the classifiers and the visual index
+    once, in the master, and freezes everything so the forked workers keep
+    sharing it copy-on-write.
+    """
+    # The master never runs OpenMP regions on more than one thread: a thread
+    # pool started before the fork would hang the first parallel op in a worker.
+    # ONNX Runtime sessions aren't opened here but in each worker, with the
+    # worker's thread count
+    torch.set_num_threads(1)
+    timings = backend.warmup()
+    for model in loaded_models():
+        freeze_model(model)
+
+    # Move everything loaded so far to the permanent generation. The collector
+    # then never walks (and writes to) the headers of those objects in the
+    # workers, which would copy every page they live on
+    gc.collect()
+    gc.freeze()
+    return timings
+
+
+def listen(host, port, backlog=128):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(sock, threads_per_worker, request_threads, metrics_dir):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    gc.enable()
+    torch.set_num_threads(threads_per_worker)
+    # Whatever the master recorded is already counted; /metrics reports the
+    # sum over all workers
+    registry.reset()
+    registry.share(metrics_dir)
+    # ONNX Runtime sessions are opened here, once the worker's thread count is set
+    for classifier in backend.get_classifiers():
+        if getattr(classifier, 'runtime', 'eager') == 'onnx':
+            classifier.model.ensure_session()
+    # Several request threads, so concurrent requests reach the micro-batcher
+    # together. The batcher and the result cache start their threads and
+    # connections lazily, in the worker that uses them
+    serve(backend.app, sockets=[sock], threads=request_threads)
+
+
+class Master:
+    """ Forks the workers off the loaded master, restarts the ones that die and stops them all on SIGTERM/SIGINT. """
+
+    def __init__(self, sock, workers, threads_per_worker, request_threads, metrics_dir, restart_delay=1.0):
+        self.sock = sock
+        self.workers = workers
+        self.threads_per_worker = threads_per_worker
+        self.request_threads = request_threads
+        self.metrics_dir = metrics_dir
+        self.restart_delay = restart_delay
+        self.children = set()
+        self.stopping = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                run_worker(self.sock, self.threads_per_worker, self.request_threads, self.metrics_dir)
+            except BaseException as e:
+                print(f"Worker {os.getpid()} failed: {e}", file=sys.stderr)
+                status = 1
+            finally:
+                os._exit(status)
+        self.children.add(pid)
+        return pid
+
+    def stop(self, signum, frame):
+        self.stopping = True
+        # The main loop may be changing the set when the signal arrives
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for _ in range(self.workers):
+            self.spawn()
+        host, port = self.sock.getsockname()[:2]
+        print(f"Serving on {host}:{port} with {self.workers} workers: {sorted(self.children)}")
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            self.children.discard(pid)
+            if not self.stopping:
+                print(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, restarting", file=sys.stderr)
+                # Don't spin when workers die right after starting
+                time.sleep(self.restart_delay)
+                self.spawn()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the API from worker processes forked after the models are loaded.')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Worker processes, defaults to the number of cores')
+    parser.add_argument('--threads-per-worker', type=int, default=1, help='Torch threads in each worker')
+    parser.add_argument('--request-threads', type=int, default=8, help='Request handling threads in each worker')
+    parser.add_argument('--metrics-dir', default=None,
+                        help='Where the workers publish their metrics for /metrics, a fresh temporary directory by default')
+    args = parser.parse_args()
+
+    # Collections during loading would be wasted work, everything loaded stays alive
+    gc.disable()
+    timings = load_shared_state()
+    print('Loaded ' + ', '.join(f"{name} in {seconds:.1f}s" for name, seconds in timings.items()))
+
+    # Files left by a previous run would be counted again
+    metrics_dir = args.metrics_dir or os.path.join(tempfile.gettempdir(), f'tcgdex-metrics-{os.getpid()}')
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+
+    sock = listen(args.host, args.port)
+    Master(sock, args.workers, args.threads_per_worker, args.request_threads, metrics_dir).run()
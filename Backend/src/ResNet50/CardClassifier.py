@@ -1,3 +1,5 @@
+import threading
+import time
 import torch
 from torchvision import transforms
 from PIL import Image
@@ -10,8 +12,13 @@ import torch
 from torchvision import datasets, models, transforms
 from torch.utils.data import DataLoader, random_split
 from textDetect.image_processor import ImagePreprocessor
+from textDetect.constants import path_debug
+from textDetect.debug_writer import DebugImageWriter
+from textDetect.metrics import registry
+from ResNet50.model_export import RUNTIMES, load_exported_model
 from torch.utils.data import Dataset, DataLoader
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.optim as optim
 import numpy as np
 from torchvision.models import resnet50, ResNet50_Weights
@@ -22,33 +29,76 @@ from sklearn.preprocessing import LabelEncoder
 import pandas as pd
 import os
 from PIL import Image
-import matplotlib.pyplot as plt
 from PIL import Image as PILImage  # Import PIL Image to avoid confusion with torchvision.transforms
 
 class CardClassifier:
-    def __init__(self, model_path, label_encoder_path, output_size=(224, 224)):
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        
-        # Load the label encoder first
-        self.label_encoder = joblib.load(label_encoder_path)
-        
-        # Now load the model, with access to the number of classes from the label encoder
-        self.model = self.load_model(model_path, output_size)
-
-        self.transform = transforms.Compose([
-            transforms.Resize(output_size),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-        ])
+
+    # One instance per model, shared across threads
+    instances = {}
+    instances_lock = threading.Lock()
+
+    def __init__(self, model_path, label_encoder_path, output_size=(224, 224), debug=False, debug_dir=path_debug, runtime='eager'):
+        if runtime not in RUNTIMES:
+            raise ValueError(f"Unknown runtime {runtime!r}, expected one of {', '.join(RUNTIMES)}")
+        # The exported graphs (see ResNet50/model_export.py) are served on the CPU
+        self.runtime = runtime
+        self.device = torch.device("cuda" if torch.cuda.is_available() and runtime == 'eager' else "cpu")
+        self.model_path = model_path
+        self.label_encoder_path = label_encoder_path
+        self.output_size = output_size
+        self.debug = debug
+        self.debug_dir = debug_dir
+
+        # The label encoder and weights are loaded on first use, see ensure_loaded
+        self.label_encoder = None
+        self.model = None
+        self.load_lock = threading.Lock()
+
+        # ImageNet normalization, shaped for (N, 3, H, W) batches
+        self.mean = torch.tensor([0.485, 0.456, 0.406], device=self.device).view(1, 3, 1, 1)
+        self.std = torch.tensor([0.229, 0.224, 0.225], device=self.device).view(1, 3, 1, 1)
+
+    @classmethod
+    def shared(cls, model_path, label_encoder_path, output_size=(224, 224), runtime='eager'):
+        """ Returns the process-wide classifier for this model, creating it on first call. """
+        key = (model_path, label_encoder_path, output_size, runtime)
+        with cls.instances_lock:
+            if key not in cls.instances:
+                cls.instances[key] = cls(model_path, label_encoder_path, output_size, runtime=runtime)
+            return cls.instances[key]
+
+    def ensure_loaded(self):
+        if self.model is None:
+            with self.load_lock:
+                if self.model is None:
+                    start = time.perf_counter()
+                    # Load the label encoder first, the model needs its number of classes
+                    self.label_encoder = joblib.load(self.label_encoder_path)
+                    self.model = self.load_model(self.model_path, self.output_size)
+                    registry.set_gauge('tcgdex_model_load_seconds', time.perf_counter() - start, model='set_classifier')
+        return self.model
+
+    def warmup(self):
+        """ Loads the weights and runs one dummy forward pass. """
+        model = self.ensure_loaded()
+        if self.runtime == 'onnx':
+            # The session opens on the first call of the process that serves, see OnnxModel
+            return
+        with torch.no_grad():
+            model(torch.zeros((1, 3) + tuple(self.output_size), device=self.device))
 
     def crop_set_symbol(self, image):
         # Resize image to a standard size for consistency
         standard_size = (600, 825)  # Example size, adjust as needed
-        try:
-            normalized_image = cv2.resize(image, standard_size)
-        except cv2.error as e:
-            print(f"Error resizing image: {e}")
-            return
+        if image.shape[1::-1] == standard_size:
+            # Already a normalized card
+            normalized_image = image
+        else:
+            try:
+                normalized_image = cv2.resize(image, standard_size)
+            except cv2.error as e:
+                print(f"Error resizing image: {e}")
+                return
 
         # Define the coordinates for the set symbol region (adjust these as needed)
         symbol_region = normalized_image[775:825, 530:600]
@@ -56,6 +106,8 @@ class CardClassifier:
         return symbol_region
 
     def load_model(self, path, output_size):
+        if self.runtime != 'eager':
+            return load_exported_model(path, self.runtime)
         num_classes = len(self.label_encoder.classes_)  # Now this line should work properly
         model = resnet50(weights=None)
         num_ftrs = model.fc.in_features
@@ -65,34 +117,65 @@ class CardClassifier:
         model.eval()
         return model
 
+    def preprocess_batch(self, images):
+        """
+        Crops and normalizes a list of BGR card images into one (N, 3, H, W)
+        tensor with vectorized ops. Returns the tensor (None if nothing could be
+        cropped) and the positions of the images it holds.
+        """
+        crops, positions = [], []
+        for i, image in enumerate(images):
+            symbol = self.crop_set_symbol(image) if image is not None else None
+            if symbol is not None:
+                crops.append(symbol)
+                positions.append(i)
+        if not crops:
+            return None, positions
+
+        # (N, H, W, BGR) uint8 -> (N, RGB, H, W) float in [0, 1], resized and normalized in one go
+        batch = torch.from_numpy(np.ascontiguousarray(np.stack(crops)[..., ::-1]))
+        batch = batch.to(self.device).permute(0, 3, 1, 2).float().div_(255)
+        batch = F.interpolate(batch, size=tuple(self.output_size), mode='bilinear', align_corners=False, antialias=True)
+        return (batch - self.mean) / self.std, positions
+
     def predict(self, image):
         if image is None:
             print("No image provided or image could not be processed.")
             return None
 
-        image = self.crop_set_symbol(image)
-        if image is None:
+        if self.debug:
+            # predict_batch crops on its own, this crop is only for the debug image
+            symbol = self.crop_set_symbol(image)
+            if symbol is not None:
+                DebugImageWriter.for_dir(self.debug_dir).save('Symbol', symbol)
+
+        prediction = self.predict_batch([image], top_k=1)[0]
+        if prediction is None:
             print("Error in cropping symbol region.")
             return None
+        return prediction[0][0] if prediction else None
 
-        # Convert NumPy array to PIL Image
-        image = PILImage.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
-
-        # Apply the predefined transforms directly here
-        image_tensor = self.transform(image)  
-        image_tensor = image_tensor.unsqueeze(0)  # Add a batch dimension
-
-        # Display processed regions
-        plt.figure(figsize=(10, 10))
-        plt.imshow(image)  # Now directly showing PIL image
-        plt.title('Symbol')
-        plt.show()
+    def predict_batch(self, images, top_k=1):
+        """
+        Predicts the set of several card images with a single forward pass.
+        Returns, per image, the top_k (set, probability) pairs, or None where
+        the image couldn't be cropped.
+        """
+        self.ensure_loaded()
+        batch, positions = self.preprocess_batch(images)
+        predictions = [None] * len(images)
+        if batch is None:
+            return predictions
 
         with torch.no_grad():
-            outputs = self.model(image_tensor.to(self.device))  # Ensure tensor is on the right device
-            _, predicted = torch.max(outputs, 1)
-            predicted_set = self.label_encoder.inverse_transform([predicted.item()])
-        return predicted_set[0]
+            probabilities = torch.softmax(self.model(batch), dim=1)
+            top_probabilities, top_indices = probabilities.topk(min(top_k, probabilities.shape[1]), dim=1)
+        top_probabilities = top_probabilities.cpu().numpy()
+        # One inverse_transform call for the whole batch
+        top_labels = self.label_encoder.inverse_transform(top_indices.cpu().numpy().ravel()).reshape(top_indices.shape)
+        for i, labels, probs in zip(positions, top_labels, top_probabilities):
+            predictions[i] = [(label, float(prob)) for label, prob in zip(labels, probs)]
+        return predictions
 
 # Example usage
 if __name__ == '__main__':
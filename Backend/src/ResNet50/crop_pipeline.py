@@ -0,0 +1,104 @@
+import argparse
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import pandas as pd
+
+# Cards are normalized to this size before cropping
+STANDARD_SIZE = (600, 825)
+
+# Symbol regions of a normalized card, as (y0, y1, x0, x1)
+SET_SYMBOL_REGION = (775, 825, 530, 600)
+ENERGY_SYMBOL_REGION = (0, 90, 450, 600)
+
+
+def crop_region(normalized_image, region):
+    y0, y1, x0, x1 = region
+    return normalized_image[y0:y1, x0:x1]
+
+
+def is_fresh(output_path, source_mtime):
+    return os.path.exists(output_path) and os.path.getmtime(output_path) >= source_mtime
+
+
+def write_image(output_path, image):
+    # Write next to the target and swap in, so an interrupted run never leaves a truncated crop that looks fresh
+    tmp_path = output_path + '.tmp.png'
+    if not cv2.imwrite(tmp_path, image):
+        return False
+    os.replace(tmp_path, output_path)
+    return True
+
+
+def crop_card(task):
+    """
+    Crops one source image into every (region, output path) pair of the task.
+    The image is read and resized once, and only if some output is missing or
+    older than the source. Returns 'cropped', 'skipped', 'missing' or 'failed'.
+    """
+    image_path, outputs = task
+    if not os.path.exists(image_path):
+        return 'missing'
+    source_mtime = os.path.getmtime(image_path)
+    outputs = [(region, output_path) for region, output_path in outputs if not is_fresh(output_path, source_mtime)]
+    if not outputs:
+        return 'skipped'
+
+    image = cv2.imread(image_path)
+    if image is None:
+        return 'failed'
+    try:
+        normalized_image = cv2.resize(image, STANDARD_SIZE)
+    except cv2.error as e:
+        print(f"Error resizing image {image_path}: {e}")
+        return 'failed'
+    for region, output_path in outputs:
+        if not write_image(output_path, crop_region(normalized_image, region)):
+            return 'failed'
+    return 'cropped'
+
+
+def init_worker():
+    # One process per core already, keep OpenCV from spawning its own threads on top
+    cv2.setNumThreads(0)
+
+
+def crop_catalog(data_csv, image_folder, specs, workers=None, chunksize=64):
+    """
+    Crops every card of data_csv found in image_folder into each (region,
+    output folder) spec, in one pass per source image. The catalog is sharded
+    across a process pool; outputs newer than their source are skipped, so
+    re-running only crops new or changed cards. Returns a Counter of outcomes.
+    """
+    for _, output_folder in specs:
+        os.makedirs(output_folder, exist_ok=True)
+    ids = pd.read_csv(data_csv, usecols=['id'])['id']
+    tasks = [(os.path.join(image_folder, f"{card_id}.png"),
+              [(region, os.path.join(output_folder, f"{card_id}.png")) for region, output_folder in specs])
+             for card_id in ids]
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+        counts = Counter(executor.map(crop_card, tasks, chunksize=chunksize))
+    print(f"Cropped {counts['cropped']}, skipped {counts['skipped']} up to date, "
+          f"{counts['missing']} missing and {counts['failed']} failed of {len(tasks)} cards.")
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Crop the set and energy symbols of every card image.')
+    parser.add_argument('--data-csv', default='PokemonCards/cardAttributes/cardAttributes.csv')
+    parser.add_argument('--image-folder', default='PokemonCards/res50_images')
+    parser.add_argument('--set-folder', default='PokemonCards/cropped_images', help='Output folder of the set symbols')
+    parser.add_argument('--energy-folder', default='PokemonCards/cropped_images_energy', help='Output folder of the energy symbols')
+    parser.add_argument('--only', choices=['set', 'energy'], help='Crop only one of the two symbols')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes, defaults to the number of cores')
+    args = parser.parse_args()
+
+    specs = []
+    if args.only != 'energy':
+        specs.append((SET_SYMBOL_REGION, args.set_folder))
+    if args.only != 'set':
+        specs.append((ENERGY_SYMBOL_REGION, args.energy_folder))
+    crop_catalog(args.data_csv, args.image_folder, specs, workers=args.workers)
@@ -0,0 +1,271 @@
+import argparse
+import json
+import os
+import shutil
+import threading
+import time
+
+import cv2
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torchvision.models import resnet50, ResNet50_Weights
+
+from textDetect.constants import card_size
+from textDetect.manifest import count_manifest, iter_manifest
+from textDetect.metrics import registry
+
+EMBEDDING_INDEX_VERSION = 2
+
+
+# Classifier heads of the checkpoints a backbone can be taken from, none of them part of the embedding
+HEAD_PREFIXES = ('fc.', 'set_head.', 'type_head.')
+
+
+def backbone_state_dict(state_dict):
+    """
+    The ResNet50 backbone weights of a set/energy CardClassifier or a
+    MultiHeadResNet50 checkpoint: heads dropped, and the backbone. and
+    DataParallel module. prefixes stripped.
+    """
+    weights = {}
+    for key, value in state_dict.items():
+        for prefix in ('module.', 'backbone.'):
+            if key.startswith(prefix):
+                key = key[len(prefix):]
+        if not key.startswith(HEAD_PREFIXES):
+            weights[key] = value
+    return weights
+
+
+class CardEmbedder:
+    """
+    Pooled ResNet50 features of whole, normalized cards. With model_path the
+    backbone of a trained CardClassifier is used, otherwise the ImageNet
+    weights. Embeddings are L2-normalized, so a dot product is the cosine
+    similarity.
+    """
+
+    def __init__(self, model_path=None, output_size=(224, 224)):
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.model_path = model_path
+        self.output_size = tuple(output_size)
+
+        if model_path:
+            backbone = resnet50(weights=None)
+            backbone.fc = nn.Identity()
+            # Strict, so a checkpoint whose keys don't line up fails instead of leaving random weights
+            backbone.load_state_dict(backbone_state_dict(torch.load(model_path, map_location=self.device)))
+        else:
+            backbone = resnet50(weights=ResNet50_Weights.DEFAULT)
+            backbone.fc = nn.Identity()
+        backbone.to(self.device)
+        backbone.eval()
+        self.backbone = backbone
+        self.dimension = 2048
+
+        self.mean = torch.tensor([0.485, 0.456, 0.406], device=self.device).view(1, 3, 1, 1)
+        self.std = torch.tensor([0.229, 0.224, 0.225], device=self.device).view(1, 3, 1, 1)
+
+    def embed_batch(self, card_images):
+        """ (N, dimension) float16 embeddings of a list of BGR card images. """
+        cards = [image if image.shape[1::-1] == card_size else cv2.resize(image, card_size) for image in card_images]
+        batch = torch.from_numpy(np.ascontiguousarray(np.stack(cards)[..., ::-1]))
+        batch = batch.to(self.device).permute(0, 3, 1, 2).float().div_(255)
+        batch = F.interpolate(batch, size=self.output_size, mode='bilinear', align_corners=False, antialias=True)
+        with torch.no_grad():
+            features = self.backbone((batch - self.mean) / self.std)
+        return F.normalize(features, dim=1).cpu().numpy().astype(np.float16)
+
+
+def partition_embeddings(embeddings, num_partitions, attempts=3):
+    # k-means on the unit sphere; cv2.kmeans wants float32
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 1e-3)
+    _, labels, centroids = cv2.kmeans(np.asarray(embeddings, dtype=np.float32), num_partitions, None, criteria,
+                                      attempts, cv2.KMEANS_PP_CENTERS)
+    centroids /= np.linalg.norm(centroids, axis=1, keepdims=True) + 1e-12
+    return labels.reshape(-1), centroids.astype(np.float16)
+
+
+def build_embedding_index(manifest_path, index_dir, embedder, batch_size=64, num_partitions=0):
+    """
+    Embeds every reference image of the dataset manifest into a float16
+    (N, 2048) embeddings.npy with the card ids alongside. With
+    num_partitions > 0 the rows are also clustered and stored grouped by
+    partition, so lookups can search only the partitions nearest the query.
+    """
+    if not os.path.exists(manifest_path):
+        raise FileNotFoundError(f"No dataset manifest at {manifest_path}")
+    total = count_manifest(manifest_path)
+    if total == 0:
+        raise ValueError(f"Dataset manifest {manifest_path} has no entries")
+    tmp_dir = index_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    embeddings = np.lib.format.open_memmap(os.path.join(tmp_dir, 'embeddings.npy'), mode='w+', dtype=np.float16,
+                                           shape=(total, embedder.dimension))
+    ids, batch, batch_ids = [], [], []
+    for entry in iter_manifest(manifest_path):
+        image = cv2.imread(entry['image_path'])
+        if image is None:
+            print(f"Skipping unreadable image {entry['image_path']}")
+            continue
+        batch.append(image)
+        batch_ids.append(entry['id'])
+        if len(batch) == batch_size:
+            embeddings[len(ids):len(ids) + len(batch)] = embedder.embed_batch(batch)
+            ids.extend(batch_ids)
+            batch, batch_ids = [], []
+    if batch:
+        embeddings[len(ids):len(ids) + len(batch)] = embedder.embed_batch(batch)
+        ids.extend(batch_ids)
+    embeddings.flush()
+
+    if not ids:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise ValueError(f"None of the images in {manifest_path} could be read")
+
+    # Unreadable images leave rows unfilled at the end
+    embeddings = np.array(embeddings[:len(ids)])
+    ids = np.array(ids)
+    # Relative to the index directory, so the index opens from any working directory
+    model_path = os.path.relpath(os.path.abspath(embedder.model_path), os.path.abspath(index_dir)) if embedder.model_path else None
+    meta = {'version': EMBEDDING_INDEX_VERSION, 'cards': len(ids), 'dimension': embedder.dimension,
+            'model_path': model_path, 'output_size': list(embedder.output_size), 'partitions': 0}
+
+    if num_partitions and len(ids) > num_partitions:
+        labels, centroids = partition_embeddings(embeddings, num_partitions)
+        order = np.argsort(labels, kind='stable')
+        embeddings, ids = embeddings[order], ids[order]
+        offsets = np.zeros(num_partitions + 1, dtype=np.int64)
+        np.cumsum(np.bincount(labels, minlength=num_partitions), out=offsets[1:])
+        np.save(os.path.join(tmp_dir, 'centroids.npy'), centroids)
+        np.save(os.path.join(tmp_dir, 'partition_offsets.npy'), offsets)
+        meta['partitions'] = num_partitions
+
+    np.save(os.path.join(tmp_dir, 'embeddings.npy'), embeddings)
+    np.save(os.path.join(tmp_dir, 'ids.npy'), ids)
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as file:
+        json.dump(meta, file)
+
+    shutil.rmtree(index_dir, ignore_errors=True)
+    os.replace(tmp_dir, index_dir)
+    return index_dir
+
+
+def top_k_rows(scores, top_k):
+    # Unordered top k with argpartition, then sorted, per query row
+    top_k = min(top_k, scores.shape[1])
+    candidates = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+    order = np.argsort(-np.take_along_axis(scores, candidates, axis=1), axis=1)
+    return np.take_along_axis(candidates, order, axis=1)
+
+
+class EmbeddingIndex:
+    """
+    Nearest-neighbour search over a saved embedding index. The float16
+    matrix is memory-mapped and scored in chunks, so it is never upcast
+    whole.
+    """
+
+    # One instance per index directory, shared across threads
+    instances = {}
+    instances_lock = threading.Lock()
+
+    def __init__(self, index_dir, chunk_size=8192):
+        self.index_dir = index_dir
+        self.chunk_size = chunk_size
+        with open(os.path.join(index_dir, 'meta.json')) as file:
+            self.meta = json.load(file)
+        if self.meta.get('version') != EMBEDDING_INDEX_VERSION:
+            raise ValueError(f"Embedding index {index_dir} has version {self.meta.get('version')}, expected {EMBEDDING_INDEX_VERSION}; rebuild it.")
+        self.embeddings = np.load(os.path.join(index_dir, 'embeddings.npy'), mmap_mode='r')
+        self.ids = np.load(os.path.join(index_dir, 'ids.npy'))
+        if self.meta['partitions']:
+            self.centroids = np.load(os.path.join(index_dir, 'centroids.npy')).astype(np.float32)
+            self.partition_offsets = np.load(os.path.join(index_dir, 'partition_offsets.npy'))
+
+        # The embedder is loaded on first lookup
+        self.embedder = None
+        self.load_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, index_dir):
+        """ Returns the process-wide index for index_dir, opening it on first call. """
+        with cls.instances_lock:
+            if index_dir not in cls.instances:
+                cls.instances[index_dir] = cls(index_dir)
+            return cls.instances[index_dir]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def ensure_embedder(self):
+        if self.embedder is None:
+            with self.load_lock:
+                if self.embedder is None:
+                    start = time.perf_counter()
+                    # Queries must be embedded exactly like the reference cards were
+                    model_path = self.meta['model_path']
+                    if model_path:
+                        model_path = os.path.join(self.index_dir, model_path)
+                    self.embedder = CardEmbedder(model_path, self.meta['output_size'])
+                    registry.set_gauge('tcgdex_model_load_seconds', time.perf_counter() - start, model='visual_embedder')
+        return self.embedder
+
+    def score_rows(self, queries, start, end):
+        scores = np.empty((len(queries), end - start), dtype=np.float32)
+        for chunk_start in range(start, end, self.chunk_size):
+            chunk_end = min(chunk_start + self.chunk_size, end)
+            chunk = np.asarray(self.embeddings[chunk_start:chunk_end], dtype=np.float32)
+            scores[:, chunk_start - start:chunk_end - start] = queries @ chunk.T
+        return scores
+
+    def search(self, queries, top_k=5, nprobe=None):
+        """
+        Top-k (card id, cosine similarity) pairs for each query embedding.
+        Exact brute force by default; on a partitioned index, nprobe limits the
+        search to the rows of the nprobe partitions closest to each query.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if len(self.ids) == 0:
+            return [[] for _ in queries]
+        if not self.meta['partitions'] or not nprobe or nprobe >= self.meta['partitions']:
+            scores = self.score_rows(queries, 0, len(self.ids))
+            rows = top_k_rows(scores, top_k)
+            return [[(str(self.ids[r]), float(scores[q, r])) for r in query_rows] for q, query_rows in enumerate(rows)]
+
+        results = []
+        probes = top_k_rows(queries @ self.centroids.T, nprobe)
+        for query, partitions in zip(queries, probes):
+            ranges = [(self.partition_offsets[p], self.partition_offsets[p + 1]) for p in partitions]
+            scores = np.concatenate([self.score_rows(query[None], start, end)[0] for start, end in ranges])
+            rows = np.concatenate([np.arange(start, end) for start, end in ranges])
+            if len(rows) == 0:
+                results.append([])
+                continue
+            best = top_k_rows(scores[None], top_k)[0]
+            results.append([(str(self.ids[rows[i]]), float(scores[i])) for i in best])
+        return results
+
+    def lookup(self, card_images, top_k=5, nprobe=None):
+        """ Top-k (card id, similarity) pairs for each warped card image. """
+        if not card_images:
+            return []
+        return self.search(self.ensure_embedder().embed_batch(card_images), top_k, nprobe)
+
+
+if __name__ == '__main__':
+    # Paths are relative to Backend/, where the app runs, like its VISUAL_INDEX_DIR
+    parser = argparse.ArgumentParser(description='Embed the reference card images into a visual lookup index.')
+    parser.add_argument('--manifest', default='PokemonCards/downloaded_images/dataset.jsonl')
+    parser.add_argument('--output', default='src/ResNet50/visual_index', help='Index directory')
+    parser.add_argument('--model-path', default=None, help='Use the backbone of this trained classifier instead of the ImageNet weights')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--partitions', type=int, default=0, help='Cluster the index into this many partitions for nprobe search')
+    args = parser.parse_args()
+
+    embedder = CardEmbedder(args.model_path)
+    print(f"Index written to {build_embedding_index(args.manifest, args.output, embedder, args.batch_size, args.partitions)}")
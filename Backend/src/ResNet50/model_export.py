@@ -0,0 +1,199 @@
+import argparse
+import copy
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+import torch
+
+RUNTIMES = ('eager', 'torchscript', 'onnx')
+
+DEFAULT_CLASSIFIERS = {
+    'set': ('ResNet50.CardClassifier', 'ResNet50/pokemon_card_classifier.pth', 'ResNet50/label_encoder.pkl'),
+    'energy': ('ResNet50_Energy.CardClassifier', 'ResNet50_Energy/pokemon_card_classifier.pth', 'ResNet50_Energy/label_encoder.pkl'),
+}
+
+
+def exported_path(model_path, runtime):
+    """ Where the export of the state dict at model_path for runtime lives: next to it, as .ts or .onnx. """
+    extension = {'torchscript': '.ts', 'onnx': '.onnx'}[runtime]
+    return os.path.splitext(model_path)[0] + extension
+
+
+def export_torchscript(model, path, output_size):
+    """
+    Traces the eval-mode model and freezes it: the weights become constants,
+    batch norms are folded into the preceding convolutions and the graph is
+    optimized for CPU inference.
+    """
+    example = torch.zeros((1, 3) + tuple(output_size))
+    with torch.no_grad():
+        traced = torch.jit.trace(model.eval(), example)
+        frozen = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+    tmp_path = path + '.tmp'
+    torch.jit.save(frozen, tmp_path)
+    os.replace(tmp_path, path)
+    return path
+
+
+def export_onnx(model, path, output_size, opset_version=17):
+    """ Exports the eval-mode model to ONNX with a dynamic batch dimension. """
+    example = torch.zeros((1, 3) + tuple(output_size))
+    tmp_path = path + '.tmp'
+    with torch.no_grad():
+        torch.onnx.export(model.eval(), example, tmp_path, input_names=['images'], output_names=['logits'],
+                          dynamic_axes={'images': {0: 'batch'}, 'logits': {0: 'batch'}},
+                          opset_version=opset_version, do_constant_folding=True)
+    os.replace(tmp_path, path)
+    return path
+
+
+class OnnxModel:
+    """
+    ONNX Runtime session on the CPU behind the call signature of a torch
+    module: (N, 3, H, W) tensor in, logits tensor out. The session fuses the
+    batch norms into the convolutions when it optimizes the graph on load.
+
+    Each process opens its own session on first call, with `threads` intra-op
+    threads or torch's thread count at that point. A process forked after
+    loading (see serve.py) neither inherits a session whose thread pool didn't
+    survive the fork nor the thread count of its parent.
+    """
+
+    def __init__(self, path, threads=None):
+        # Optional dependency, only needed for the onnx runtime
+        import onnxruntime
+        self.onnxruntime = onnxruntime
+        self.path = path
+        self.threads = threads
+        # Opened by the first call in each process, see ensure_session
+        self.session = None
+        self.session_pid = None
+        self.input_name = None
+        self.session_lock = threading.Lock()
+
+    def ensure_session(self):
+        if self.session is None or self.session_pid != os.getpid():
+            with self.session_lock:
+                if self.session is None or self.session_pid != os.getpid():
+                    options = self.onnxruntime.SessionOptions()
+                    options.graph_optimization_level = self.onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+                    options.intra_op_num_threads = self.threads or torch.get_num_threads()
+                    session = self.onnxruntime.InferenceSession(self.path, options, providers=['CPUExecutionProvider'])
+                    self.input_name = session.get_inputs()[0].name
+                    self.session, self.session_pid = session, os.getpid()
+        return self.session
+
+    def __call__(self, batch):
+        session = self.ensure_session()
+        images = np.ascontiguousarray(batch.detach().cpu().numpy(), dtype=np.float32)
+        return torch.from_numpy(session.run(None, {self.input_name: images})[0])
+
+
+def load_exported_model(model_path, runtime):
+    """ The exported model of the state dict at model_path, ready to be called like the eager one. """
+    path = exported_path(model_path, runtime)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No {runtime} export at {path}; run ResNet50/model_export.py first.")
+    if runtime == 'torchscript':
+        model = torch.jit.load(path, map_location='cpu')
+        model.eval()
+        return model
+    return OnnxModel(path)
+
+
+def check_parity(eager_model, exported_model, output_size, batch_size=8, atol=1e-3, seed=0):
+    """
+    Runs the same random batch through both models. Returns the largest
+    absolute difference of the logits, whether every image got the same top
+    class, and whether the difference is within atol.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    batch = torch.randn((batch_size, 3) + tuple(output_size), generator=generator)
+    with torch.no_grad():
+        expected = eager_model(batch).cpu()
+        actual = exported_model(batch).cpu()
+    max_difference = float((expected - actual).abs().max())
+    same_top_class = bool((expected.argmax(dim=1) == actual.argmax(dim=1)).all())
+    return {'max_abs_difference': max_difference, 'same_top_class': same_top_class,
+            'passed': max_difference <= atol and same_top_class}
+
+
+def time_model(model, output_size, batch_size=8, repeat=10):
+    """ Median seconds per image of a forward pass over a batch_size batch. """
+    batch = torch.zeros((batch_size, 3) + tuple(output_size))
+    times = []
+    with torch.no_grad():
+        model(batch)
+        for _ in range(repeat):
+            start = time.perf_counter()
+            model(batch)
+            times.append((time.perf_counter() - start) / batch_size)
+    return float(np.median(times))
+
+
+def export_classifier(classifier, runtimes, check=True, atol=1e-3, benchmark=False):
+    """
+    Exports the eager model of a CardClassifier for each of runtimes and,
+    with check, compares the exported outputs against the eager ones.
+    Returns a report per runtime.
+    """
+    # The exports run on the CPU, like the runtimes that load them. A copy, so
+    # the classifier keeps serving from its own device
+    eager_model = copy.deepcopy(classifier.ensure_loaded()).cpu().eval()
+    reports = {}
+    for runtime in runtimes:
+        path = exported_path(classifier.model_path, runtime)
+        start = time.perf_counter()
+        if runtime == 'torchscript':
+            export_torchscript(eager_model, path, classifier.output_size)
+        else:
+            export_onnx(eager_model, path, classifier.output_size)
+        report = {'path': path, 'export_seconds': time.perf_counter() - start}
+
+        start = time.perf_counter()
+        exported_model = load_exported_model(classifier.model_path, runtime)
+        report['load_seconds'] = time.perf_counter() - start
+        if check:
+            report['parity'] = check_parity(eager_model, exported_model, classifier.output_size, atol=atol)
+        if benchmark:
+            report['seconds_per_image'] = time_model(exported_model, classifier.output_size)
+        reports[runtime] = report
+    if benchmark:
+        reports['eager'] = {'seconds_per_image': time_model(eager_model, classifier.output_size)}
+    return reports
+
+
+if __name__ == '__main__':
+    import importlib
+
+    parser = argparse.ArgumentParser(description='Export the trained set and energy classifiers to TorchScript and ONNX.')
+    parser.add_argument('--classifier', choices=list(DEFAULT_CLASSIFIERS) + ['all'], default='all')
+    parser.add_argument('--runtimes', nargs='+', choices=RUNTIMES[1:], default=list(RUNTIMES[1:]))
+    parser.add_argument('--atol', type=float, default=1e-3, help='Largest logit difference from the eager model that passes the parity check')
+    parser.add_argument('--skip-check', action='store_true', help="Don't compare the exported outputs against the eager ones")
+    parser.add_argument('--benchmark', action='store_true', help='Also time a forward pass of the eager and exported models')
+    args = parser.parse_args()
+
+    failed = False
+    names = list(DEFAULT_CLASSIFIERS) if args.classifier == 'all' else [args.classifier]
+    for name in names:
+        module, model_path, label_encoder_path = DEFAULT_CLASSIFIERS[name]
+        classifier = importlib.import_module(module).CardClassifier(model_path, label_encoder_path)
+        for runtime, report in export_classifier(classifier, args.runtimes, not args.skip_check, args.atol, args.benchmark).items():
+            line = f"{name} {runtime}:"
+            if 'path' in report:
+                line += f" {report['path']} (exported in {report['export_seconds']:.1f}s, loads in {report['load_seconds']:.2f}s)"
+            if 'parity' in report:
+                parity = report['parity']
+                line += f", max logit difference {parity['max_abs_difference']:.2e}, same top class: {parity['same_top_class']}"
+                failed = failed or not parity['passed']
+            if 'seconds_per_image' in report:
+                line += f", {1000 * report['seconds_per_image']:.2f} ms/image"
+            print(line)
+
+    if failed:
+        print(f"Parity check failed beyond {args.atol}")
+        sys.exit(1)
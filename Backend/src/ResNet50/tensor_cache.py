@@ -0,0 +1,96 @@
+import json
+import os
+import shutil
+
+import numpy as np
+from PIL import Image
+
+TENSOR_CACHE_VERSION = 1
+
+
+def default_cache_dir(img_dir, output_size):
+    return f"{os.path.normpath(img_dir)}.{output_size[0]}x{output_size[1]}.cache"
+
+
+def build_tensor_cache(ids, paths, labels, cache_dir, output_size):
+    """
+    Decodes every crop once, resizes it to output_size and writes the lot into
+    a single (N, 3, H, W) uint8 images.npy, with the ids and labels alongside.
+    The resize is the same PIL bilinear resize transforms.Resize applies.
+    """
+    height, width = output_size
+    tmp_dir = cache_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    images = np.lib.format.open_memmap(os.path.join(tmp_dir, 'images.npy'), mode='w+', dtype=np.uint8,
+                                       shape=(len(paths), 3, height, width))
+    for i, path in enumerate(paths):
+        image = Image.open(path).convert('RGB').resize((width, height), Image.BILINEAR)
+        images[i] = np.asarray(image).transpose(2, 0, 1)
+    images.flush()
+    del images
+
+    np.save(os.path.join(tmp_dir, 'ids.npy'), np.asarray(ids))
+    np.save(os.path.join(tmp_dir, 'labels.npy'), np.asarray(labels))
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as file:
+        json.dump({'version': TENSOR_CACHE_VERSION, 'output_size': list(output_size), 'images': len(paths)}, file)
+
+    # Swap in whole, so a crashed build never leaves a half-written cache behind
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.replace(tmp_dir, cache_dir)
+    return cache_dir
+
+
+class TensorCache:
+    """
+    Read-only view of a tensor cache. images.npy is memory-mapped on first
+    access in each process, so DataLoader workers share the page cache instead
+    of each receiving a pickled copy of the array.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, 'meta.json')) as file:
+            self.meta = json.load(file)
+        if self.meta.get('version') != TENSOR_CACHE_VERSION:
+            raise ValueError(f"Tensor cache {cache_dir} has version {self.meta.get('version')}, expected {TENSOR_CACHE_VERSION}; rebuild it.")
+        self.ids = np.load(os.path.join(cache_dir, 'ids.npy'))
+        self.labels = np.load(os.path.join(cache_dir, 'labels.npy'))
+        self.mapped_images = None
+
+    @property
+    def images(self):
+        if self.mapped_images is None:
+            # Copy-on-write, so torch.from_numpy gets a writable array without touching the file
+            self.mapped_images = np.load(os.path.join(self.cache_dir, 'images.npy'), mmap_mode='c')
+        return self.mapped_images
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['mapped_images'] = None
+        return state
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def load_tensor_cache(ids, paths, labels, cache_dir, output_size):
+    """ Opens the tensor cache in cache_dir, rebuilding it if it is missing or doesn't match these crops. """
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    cache = None
+    if os.path.exists(meta_path):
+        try:
+            cache = TensorCache(cache_dir)
+        except ValueError:
+            cache = None
+    stale = (cache is None
+             or cache.meta.get('output_size') != list(output_size)
+             or not np.array_equal(cache.ids, np.asarray(ids))
+             or not np.array_equal(cache.labels, np.asarray(labels))
+             or any(os.path.getmtime(path) > os.path.getmtime(meta_path) for path in paths))
+    if stale:
+        print(f"Building tensor cache {cache_dir} for {len(paths)} images...")
+        build_tensor_cache(ids, paths, labels, cache_dir, output_size)
+        cache = TensorCache(cache_dir)
+    return cache
@@ -1,11 +1,16 @@
+import ast
+import argparse
 import cv2
 import os
+import time
 import pandas as pd
 from PIL import Image
 import torch
 from torchvision import datasets, models, transforms
 from torch.utils.data import DataLoader, random_split
 from textDetect.image_processor import ImagePreprocessor
+from ResNet50.crop_pipeline import ENERGY_SYMBOL_REGION, crop_catalog, crop_region
+from ResNet50.tensor_cache import default_cache_dir, load_tensor_cache
 from torch.utils.data import Dataset, DataLoader
 import torch.nn as nn
 import torch.optim as optim
@@ -22,74 +27,114 @@ from sklearn.preprocessing import MultiLabelBinarizer
 
 
 class PokemonDataset(Dataset):
-    def __init__(self, csv_file, img_dir, transform=None):
-        self.card_attrs = pd.read_csv(csv_file)
+    def __init__(self, csv_file, img_dir, transform=None, cache_dir=None, cache_size=(224, 224)):
+        card_attrs = pd.read_csv(csv_file)
         self.img_dir = img_dir
         self.transform = transform
 
-        self.id_to_type = {}
-        self.types = []
-
-        for index, row in self.card_attrs.iterrows():
-            img_path = os.path.join(img_dir, f"{row['id']}.png")
+        id_to_type = {}
+        for row in card_attrs.itertuples(index=False):
+            img_path = os.path.join(img_dir, f"{row.id}.png")
             if os.path.exists(img_path):
                 # Parse types which are expected to be stored as list
-                card_types = eval(row['types'])
-                self.id_to_type[row['id']] = card_types
-                self.types.extend(card_types)
+                id_to_type[row.id] = ast.literal_eval(row.types)
 
-        self.types = list(set(self.types))  # Remove duplicates
         self.encoder = MultiLabelBinarizer()
-        self.encoder.fit([self.types])
+        self.encoder.fit([sorted({card_type for card_types in id_to_type.values() for card_type in card_types})])
+
+        # Aligned arrays built once, so __getitem__ is O(1) and the dataset pickles cheaply to DataLoader workers
+        self.ids = np.array(list(id_to_type.keys()))
+        self.paths = np.array([os.path.join(img_dir, f"{img_id}.png") for img_id in self.ids])
+        self.labels = self.encoder.transform(list(id_to_type.values())).astype(np.float32)  # Float for BCE loss
+
+        # With a cache_dir the crops are read pre-resized from a memory-mapped tensor cache,
+        # and transform gets a (3, H, W) float tensor in [0, 1] instead of a PIL image
+        self.cache = load_tensor_cache(self.ids, self.paths, self.labels, cache_dir, cache_size) if cache_dir else None
 
     def __len__(self):
-        return len(self.id_to_type)
+        return len(self.ids)
 
     def __getitem__(self, idx):
-        img_id = list(self.id_to_type.keys())[idx]
-        img_name = os.path.join(self.img_dir, f"{img_id}.png")
-        image = Image.open(img_name).convert('RGB')
-        types = self.id_to_type[img_id]
-
-        label = self.encoder.transform([types])[0]
+        if self.cache is not None:
+            image = torch.from_numpy(self.cache.images[idx]).float().div_(255)
+        else:
+            image = Image.open(self.paths[idx]).convert('RGB')
 
         if self.transform:
             image = self.transform(image)
 
-        return img_id, image, torch.tensor(label, dtype=torch.float)  # Use float for BCE loss
+        return str(self.ids[idx]), image, torch.from_numpy(self.labels[idx])
 
 class PokemonCardClassifier:
-    def __init__(self, data_csv, image_folder, cropped_folder, output_size=(224, 224)):
+    def __init__(self, data_csv, image_folder, cropped_folder, output_size=(224, 224),
+                 batch_size=32, num_workers=0, prefetch_factor=2, pin_memory=None, tensor_cache=False):
         self.data_csv = data_csv
         self.cropped_folder = cropped_folder
         self.image_folder = image_folder
         self.output_size = output_size
+        # DataLoader settings; pin_memory=None pins only when training on CUDA
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.prefetch_factor = prefetch_factor
+        self.tensor_cache = tensor_cache
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.pin_memory = self.device.type == 'cuda' if pin_memory is None else pin_memory
         self.model = None
 
-        transform = transforms.Compose([
-            transforms.Resize(output_size),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-        ])
-
-        self.dataset = PokemonDataset(csv_file=data_csv, img_dir=cropped_folder, transform=transform)
+        if tensor_cache:
+            # Cached crops are already resized tensors, only normalization is left
+            transform = transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+        else:
+            transform = transforms.Compose([
+                transforms.Resize(output_size),
+                transforms.ToTensor(),
+                transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+            ])
+
+        cache_dir = default_cache_dir(cropped_folder, output_size) if tensor_cache else None
+        self.dataset = PokemonDataset(csv_file=data_csv, img_dir=cropped_folder, transform=transform,
+                                      cache_dir=cache_dir, cache_size=output_size)
         train_size = int(0.8 * len(self.dataset))
         val_size = len(self.dataset) - train_size
         self.train_dataset, self.val_dataset = random_split(self.dataset, [train_size, val_size])
 
-        self.train_loader = DataLoader(self.train_dataset, batch_size=32, shuffle=True)
-        self.val_loader = DataLoader(self.val_dataset, batch_size=32, shuffle=False)
-
-    def crop_images(self):
-        attributes = pd.read_csv(self.data_csv)
-        for index, row in attributes.iterrows():
-            image_path = os.path.join(self.image_folder, f"{row['id']}.png")
-            output_path = os.path.join(self.cropped_folder, f"{row['id']}.png")
-            if os.path.exists(image_path):
-                image = cv2.imread(image_path)
-                if image is not None:
-                    self.crop_energy_symbol(image, output_path)
+        self.train_loader = self.make_loader(self.train_dataset, shuffle=True)
+        self.val_loader = self.make_loader(self.val_dataset, shuffle=False)
+
+    def make_loader(self, dataset, shuffle, num_workers=None):
+        num_workers = self.num_workers if num_workers is None else num_workers
+        options = {'batch_size': self.batch_size, 'shuffle': shuffle, 'num_workers': num_workers, 'pin_memory': self.pin_memory}
+        if num_workers > 0:
+            # Keep workers alive between epochs and let each one run ahead by prefetch_factor batches
+            options.update(persistent_workers=True, prefetch_factor=self.prefetch_factor)
+        return DataLoader(dataset, **options)
+
+    def benchmark_loader(self, worker_counts=(0, 2, 4, 8), num_batches=None):
+        """
+        Iterates the training loader without running the model, once per worker
+        count, and prints the samples/sec each one delivers.
+        """
+        results = {}
+        for num_workers in worker_counts:
+            loader = self.make_loader(self.train_dataset, shuffle=True, num_workers=num_workers)
+            start = time.perf_counter()
+            first_batch = None
+            samples = 0
+            for i, batch in enumerate(loader):
+                if first_batch is None:
+                    first_batch = time.perf_counter() - start
+                samples += len(batch[0])
+                if num_batches is not None and i + 1 >= num_batches:
+                    break
+            elapsed = time.perf_counter() - start
+            results[num_workers] = samples / elapsed if elapsed > 0 else 0.0
+            print(f'num_workers={num_workers}: {results[num_workers]:.1f} samples/sec, first batch after {first_batch or 0:.2f}s')
+            del loader
+        return results
+
+    def crop_images(self, workers=None):
+        # Sharded across a process pool; crops newer than their source image are skipped
+        crop_catalog(self.data_csv, self.image_folder, [(ENERGY_SYMBOL_REGION, self.cropped_folder)], workers=workers)
 
     def crop_energy_symbol(self, image, output_path):
         # Resize image to a standard size for consistency
@@ -101,7 +146,7 @@ class PokemonCardClassifier:
             return
 
         # Define the coordinates for the set symbol region (adjust these as needed)
-        symbol_region = normalized_image[0:90, 450:600]
+        symbol_region = crop_region(normalized_image, ENERGY_SYMBOL_REGION)
 
         # Save the cropped region to the specified output path
         cv2.imwrite(output_path, symbol_region)
@@ -122,15 +167,19 @@ class PokemonCardClassifier:
         for epoch in range(num_epochs):
             self.model.train()
             running_loss = 0.0
+            samples = 0
+            start = time.perf_counter()
             for img_ids, inputs, labels in self.train_loader:  # Add img_ids here
-                inputs, labels = inputs.to(self.device), labels.to(self.device)
+                inputs, labels = inputs.to(self.device, non_blocking=True), labels.to(self.device, non_blocking=True)
+                samples += labels.size(0)
                 optimizer.zero_grad()
                 outputs = self.model(inputs)
                 loss = criterion(outputs, labels)
                 loss.backward()
                 optimizer.step()
                 running_loss += loss.item()
-            print(f'Epoch [{epoch + 1}/{num_epochs}], Loss: {running_loss / len(self.train_loader):.4f}')
+            throughput = samples / (time.perf_counter() - start)
+            print(f'Epoch [{epoch + 1}/{num_epochs}], Loss: {running_loss / len(self.train_loader):.4f}, Throughput: {throughput:.1f} samples/sec')
 
     def evaluate_model(self):
         self.model.eval()
@@ -181,11 +230,29 @@ class PokemonCardClassifier:
         joblib.dump(self.dataset.encoder, path)
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train the energy classifier.')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--num-workers', type=int, default=0, help='DataLoader worker processes')
+    parser.add_argument('--prefetch-factor', type=int, default=2, help='Batches prefetched per worker')
+    parser.add_argument('--benchmark-loader', type=int, nargs='+', metavar='NUM_WORKERS',
+                        help='Only time the data loader for each of these worker counts, without training')
+    parser.add_argument('--benchmark-batches', type=int, default=None, help='Batches read per benchmark run')
+    parser.add_argument('--tensor-cache', action='store_true',
+                        help='Train from a memory-mapped cache of pre-resized crops, built on first use')
+    args = parser.parse_args()
+
     classifier = PokemonCardClassifier(
         data_csv='PokemonCards/cardAttributes/cardAttributes.csv',
         image_folder='PokemonCards/res50_images',
-        cropped_folder='PokemonCards/cropped_images_energy'
+        cropped_folder='PokemonCards/cropped_images_energy',
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        prefetch_factor=args.prefetch_factor,
+        tensor_cache=args.tensor_cache
     )
+    if args.benchmark_loader:
+        classifier.benchmark_loader(args.benchmark_loader, args.benchmark_batches)
+        raise SystemExit
     # classifier.crop_images()
     # To load images, comment out lines 76-82
 
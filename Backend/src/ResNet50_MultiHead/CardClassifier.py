@@ -0,0 +1,142 @@
+import threading
+import time
+
+import cv2
+import joblib
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from ResNet50.crop_pipeline import ENERGY_SYMBOL_REGION, SET_SYMBOL_REGION, STANDARD_SIZE, crop_region
+from ResNet50_MultiHead.resnet50model import MultiHeadResNet50
+from textDetect.metrics import registry
+
+
+class CardClassifier:
+    """
+    Inference for the shared-backbone model: one forward pass gives the set
+    and the energy types of a card.
+    """
+
+    # One instance per model, shared across threads
+    instances = {}
+    instances_lock = threading.Lock()
+
+    def __init__(self, model_path, label_encoder_path, output_size=(224, 224)):
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.model_path = model_path
+        self.label_encoder_path = label_encoder_path
+        self.output_size = output_size
+
+        # The label encoders and weights are loaded on first use, see ensure_loaded
+        self.set_encoder = None
+        self.type_encoder = None
+        self.model = None
+        self.load_lock = threading.Lock()
+
+        self.mean = torch.tensor([0.485, 0.456, 0.406], device=self.device).view(1, 3, 1, 1)
+        self.std = torch.tensor([0.229, 0.224, 0.225], device=self.device).view(1, 3, 1, 1)
+
+    @classmethod
+    def shared(cls, model_path, label_encoder_path, output_size=(224, 224)):
+        """ Returns the process-wide classifier for this model, creating it on first call. """
+        key = (model_path, label_encoder_path, output_size)
+        with cls.instances_lock:
+            if key not in cls.instances:
+                cls.instances[key] = cls(model_path, label_encoder_path, output_size)
+            return cls.instances[key]
+
+    def ensure_loaded(self):
+        if self.model is None:
+            with self.load_lock:
+                if self.model is None:
+                    start = time.perf_counter()
+                    encoders = joblib.load(self.label_encoder_path)
+                    self.set_encoder, self.type_encoder = encoders['set'], encoders['types']
+                    model = MultiHeadResNet50(len(self.set_encoder.classes_), len(self.type_encoder.classes_))
+                    model.load_state_dict(torch.load(self.model_path, map_location=self.device))
+                    model.to(self.device)
+                    model.eval()
+                    self.model = model
+                    registry.set_gauge('tcgdex_model_load_seconds', time.perf_counter() - start, model='multihead_classifier')
+        return self.model
+
+    def warmup(self):
+        """ Loads the weights and runs one dummy forward pass. """
+        model = self.ensure_loaded()
+        dummy = torch.zeros((1, 3) + tuple(self.output_size), device=self.device)
+        with torch.no_grad():
+            model(dummy, dummy)
+
+    @staticmethod
+    def crop_symbols(image):
+        # Set symbol and energy symbol regions of the card, the same ones the training crops use
+        if image.shape[1::-1] != STANDARD_SIZE:
+            try:
+                image = cv2.resize(image, STANDARD_SIZE)
+            except cv2.error as e:
+                print(f"Error resizing image: {e}")
+                return None, None
+        return crop_region(image, SET_SYMBOL_REGION), crop_region(image, ENERGY_SYMBOL_REGION)
+
+    def to_batch(self, crops):
+        # (N, H, W, BGR) uint8 -> normalized (N, RGB, H, W) float
+        batch = torch.from_numpy(np.ascontiguousarray(np.stack(crops)[..., ::-1]))
+        batch = batch.to(self.device).permute(0, 3, 1, 2).float().div_(255)
+        batch = F.interpolate(batch, size=tuple(self.output_size), mode='bilinear', align_corners=False, antialias=True)
+        return (batch - self.mean) / self.std
+
+    def predict_batch(self, images, top_k=1, threshold=0.5):
+        """
+        Classifies several card images with one forward pass. Returns, per
+        image, a (top sets, types) pair: the top_k (set, probability) pairs and
+        the (type, probability) pairs whose sigmoid clears threshold. Images
+        that can't be cropped give None.
+        """
+        self.ensure_loaded()
+        set_crops, type_crops, positions = [], [], []
+        for i, image in enumerate(images):
+            set_crop, type_crop = self.crop_symbols(image) if image is not None else (None, None)
+            if set_crop is not None:
+                set_crops.append(set_crop)
+                type_crops.append(type_crop)
+                positions.append(i)
+
+        predictions = [None] * len(images)
+        if not positions:
+            return predictions
+
+        with torch.no_grad():
+            set_outputs, type_outputs = self.model(self.to_batch(set_crops), self.to_batch(type_crops))
+            set_probabilities = torch.softmax(set_outputs, dim=1)
+            top_probabilities, top_indices = set_probabilities.topk(min(top_k, set_probabilities.shape[1]), dim=1)
+            type_probabilities = torch.sigmoid(type_outputs).cpu().numpy()
+
+        top_probabilities = top_probabilities.cpu().numpy()
+        top_labels = self.set_encoder.inverse_transform(top_indices.cpu().numpy().ravel()).reshape(top_indices.shape)
+        type_order = np.argsort(-type_probabilities, axis=1)
+        for i, labels, probs, row, row_order in zip(positions, top_labels, top_probabilities, type_probabilities, type_order):
+            top_sets = [(label, float(prob)) for label, prob in zip(labels, probs)]
+            types = [(self.type_encoder.classes_[c], float(row[c])) for c in row_order if row[c] > threshold]
+            predictions[i] = (top_sets, types)
+        return predictions
+
+    def predict(self, image):
+        """ Returns (set, types) for one card image, or None. """
+        if image is None:
+            print("No image provided or image could not be processed.")
+            return None
+        prediction = self.predict_batch([image])[0]
+        if prediction is None:
+            return None
+        top_sets, types = prediction
+        return top_sets[0][0], [energy_type for energy_type, _ in types]
+
+
+if __name__ == '__main__':
+    classifier = CardClassifier(
+        model_path='ResNet50_MultiHead/pokemon_card_classifier.pth',
+        label_encoder_path='ResNet50_MultiHead/label_encoder.pkl'
+    )
+    image = cv2.imread('PokemonCards/testImage/col1-33.png')
+    print("Predicted Set and Types:", classifier.predict(image))
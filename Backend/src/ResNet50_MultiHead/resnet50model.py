@@ -0,0 +1,178 @@
+import argparse
+import ast
+import os
+import time
+
+import joblib
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from PIL import Image
+from sklearn.preprocessing import LabelEncoder, MultiLabelBinarizer
+from torch.utils.data import Dataset
+from torchvision.models import resnet50, ResNet50_Weights
+
+from ResNet50.crop_pipeline import ENERGY_SYMBOL_REGION, SET_SYMBOL_REGION, crop_catalog
+from ResNet50.resnet50model import PokemonCardClassifier
+
+
+class MultiHeadResNet50(nn.Module):
+    """
+    One ResNet50 backbone shared by two heads: the set of the card (softmax)
+    and its energy types (sigmoid, multi-label). Both crops go through the
+    backbone as a single batch.
+    """
+
+    def __init__(self, num_sets, num_types, weights=None):
+        super().__init__()
+        self.backbone = resnet50(weights=weights)
+        num_ftrs = self.backbone.fc.in_features
+        self.backbone.fc = nn.Identity()
+        self.set_head = nn.Linear(num_ftrs, num_sets)
+        self.type_head = nn.Linear(num_ftrs, num_types)
+
+    def forward(self, set_images, type_images):
+        features = self.backbone(torch.cat([set_images, type_images]))
+        n = len(set_images)
+        return self.set_head(features[:n]), self.type_head(features[n:])
+
+
+class MultiHeadDataset(Dataset):
+    def __init__(self, csv_file, set_dir, type_dir, transform=None):
+        card_attrs = pd.read_csv(csv_file)
+        self.set_dir = set_dir
+        self.type_dir = type_dir
+        self.transform = transform
+
+        # Only cards with both crops on disk are used
+        ids, sets, types = [], [], []
+        for row in card_attrs.itertuples(index=False):
+            if os.path.exists(os.path.join(set_dir, f"{row.id}.png")) and os.path.exists(os.path.join(type_dir, f"{row.id}.png")):
+                ids.append(row.id)
+                sets.append(row.set)
+                types.append(ast.literal_eval(row.types) if pd.notna(row.types) else [])
+
+        self.set_encoder = LabelEncoder()
+        self.type_encoder = MultiLabelBinarizer()
+        self.ids = np.array(ids)
+        self.set_labels = self.set_encoder.fit_transform(sets).astype(np.int64)
+        self.type_labels = self.type_encoder.fit_transform(types).astype(np.float32)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def load_image(self, img_dir, img_id):
+        image = Image.open(os.path.join(img_dir, f"{img_id}.png")).convert('RGB')
+        return self.transform(image) if self.transform else image
+
+    def __getitem__(self, idx):
+        img_id = str(self.ids[idx])
+        return (img_id,
+                self.load_image(self.set_dir, img_id),
+                self.load_image(self.type_dir, img_id),
+                torch.tensor(self.set_labels[idx]),
+                torch.from_numpy(self.type_labels[idx]))
+
+
+class MultiHeadCardClassifier(PokemonCardClassifier):
+    """ Trains the set and energy classifiers as one shared-backbone model. """
+
+    def __init__(self, data_csv, image_folder, cropped_folder, energy_cropped_folder, output_size=(224, 224), **loader_options):
+        # MultiHeadDataset reads both crops from disk as PIL images, the Normalize-only
+        # transform of a tensor cache would crash on them
+        if loader_options.get('tensor_cache'):
+            raise ValueError("The multi-head classifier doesn't support tensor_cache.")
+        self.energy_cropped_folder = energy_cropped_folder
+        super().__init__(data_csv, image_folder, cropped_folder, output_size, **loader_options)
+
+    def build_dataset(self, transform):
+        return MultiHeadDataset(self.data_csv, self.cropped_folder, self.energy_cropped_folder, transform=transform)
+
+    def crop_images(self, workers=None):
+        # Both crops come from the same resized card, so each source image is read once
+        crop_catalog(self.data_csv, self.image_folder,
+                     [(SET_SYMBOL_REGION, self.cropped_folder), (ENERGY_SYMBOL_REGION, self.energy_cropped_folder)],
+                     workers=workers)
+
+    def configure_model(self):
+        self.model = MultiHeadResNet50(len(self.dataset.set_encoder.classes_), len(self.dataset.type_encoder.classes_),
+                                       weights=ResNet50_Weights.DEFAULT)
+        self.model.to(self.device)
+
+    def train_model(self, num_epochs=10):
+        set_criterion = nn.CrossEntropyLoss()
+        type_criterion = nn.BCEWithLogitsLoss()
+        optimizer = optim.Adam(self.model.parameters(), lr=0.001)
+        for epoch in range(num_epochs):
+            self.model.train()
+            running_loss = 0.0
+            samples = 0
+            start = time.perf_counter()
+            for img_ids, set_inputs, type_inputs, set_labels, type_labels in self.train_loader:
+                set_inputs, type_inputs = set_inputs.to(self.device, non_blocking=True), type_inputs.to(self.device, non_blocking=True)
+                set_labels, type_labels = set_labels.to(self.device, non_blocking=True), type_labels.to(self.device, non_blocking=True)
+                samples += set_labels.size(0)
+                optimizer.zero_grad()
+                set_outputs, type_outputs = self.model(set_inputs, type_inputs)
+                loss = set_criterion(set_outputs, set_labels) + type_criterion(type_outputs, type_labels)
+                loss.backward()
+                optimizer.step()
+                running_loss += loss.item()
+            throughput = samples / (time.perf_counter() - start)
+            print(f'Epoch [{epoch + 1}/{num_epochs}], Loss: {running_loss / len(self.train_loader):.4f}, Throughput: {throughput:.1f} samples/sec')
+
+    def evaluate_model(self):
+        self.model.eval()
+        total = set_correct = type_exact = 0
+        with torch.no_grad():
+            for img_ids, set_inputs, type_inputs, set_labels, type_labels in self.val_loader:
+                set_inputs, type_inputs = set_inputs.to(self.device), type_inputs.to(self.device)
+                set_labels, type_labels = set_labels.to(self.device), type_labels.to(self.device)
+                set_outputs, type_outputs = self.model(set_inputs, type_inputs)
+                predicted_types = (torch.sigmoid(type_outputs) > 0.5).float()
+                total += set_labels.size(0)
+                set_correct += (set_outputs.argmax(1) == set_labels).sum().item()
+                type_exact += (predicted_types == type_labels).all(dim=1).sum().item()
+
+        print(f'Set accuracy on validation set: {100 * set_correct / total:.2f}%')
+        print(f'Type exact match ratio on validation set: {100 * type_exact / total:.2f}%')
+
+    def save_model(self, path='ResNet50_MultiHead/pokemon_card_classifier.pth'):
+        """ Saves the model's state dictionary to a file. """
+        torch.save(self.model.state_dict(), path)
+
+    def save_label_encoder(self, path='ResNet50_MultiHead/label_encoder.pkl'):
+        """ Saves both label encoders using joblib. """
+        joblib.dump({'set': self.dataset.set_encoder, 'types': self.dataset.type_encoder}, path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train the multi-head set/energy classifier.')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--num-workers', type=int, default=0, help='DataLoader worker processes')
+    parser.add_argument('--prefetch-factor', type=int, default=2, help='Batches prefetched per worker')
+    parser.add_argument('--benchmark-loader', type=int, nargs='+', metavar='NUM_WORKERS',
+                        help='Only time the data loader for each of these worker counts, without training')
+    parser.add_argument('--benchmark-batches', type=int, default=None, help='Batches read per benchmark run')
+    args = parser.parse_args()
+
+    classifier = MultiHeadCardClassifier(
+        data_csv='PokemonCards/cardAttributes/cardAttributes.csv',
+        image_folder='PokemonCards/res50_images',
+        cropped_folder='PokemonCards/cropped_images',
+        energy_cropped_folder='PokemonCards/cropped_images_energy',
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        prefetch_factor=args.prefetch_factor
+    )
+    if args.benchmark_loader:
+        classifier.benchmark_loader(args.benchmark_loader, args.benchmark_batches)
+        raise SystemExit
+    # classifier.crop_images()
+    classifier.configure_model()
+    classifier.train_model(10)
+    classifier.evaluate_model()
+    classifier.save_model()
+    classifier.save_label_encoder()
@@ -21,36 +21,31 @@ from yolov5.utils.general import non_max_suppression, scale_coords
 
 class PokemonDataset(Dataset):
     def __init__(self, csv_file, img_dir, transform=None):
-        self.card_attrs = pd.read_csv(csv_file)
+        card_attrs = pd.read_csv(csv_file)
         self.img_dir = img_dir
         self.transform = transform
 
-        self.id_to_set = {}
-        self.sets = []
-
-        for index, row in self.card_attrs.iterrows():
-            img_path = os.path.join(img_dir, f"{row['id']}.png")
+        id_to_set = {}
+        for row in card_attrs.itertuples(index=False):
+            img_path = os.path.join(img_dir, f"{row.id}.png")
             if os.path.exists(img_path):
-                self.id_to_set[row['id']] = row['set']
-                self.sets.append(row['set'])
+                id_to_set[row.id] = row.set
 
         # Encode the set names into indices
         self.encoder = LabelEncoder()
-        self.encoder.fit(self.sets)
+
+        # Aligned arrays built once, so __getitem__ is O(1) and the dataset pickles cheaply to DataLoader workers
+        self.ids = np.array(list(id_to_set.keys()))
+        self.paths = np.array([os.path.join(img_dir, f"{img_id}.png") for img_id in self.ids])
+        self.labels = self.encoder.fit_transform(list(id_to_set.values())).astype(np.int64)
 
     def __len__(self):
-        return len(self.id_to_set)
+        return len(self.ids)
 
     def __getitem__(self, idx):
-        img_id = list(self.id_to_set.keys())[idx]
-        img_name = os.path.join(self.img_dir, f"{img_id}.png")
-        image = Image.open(img_name).convert('RGB')
-        set_name = self.id_to_set[img_id]
-
-        # Convert set name to a numeric label
-        label = self.encoder.transform([set_name])[0]
+        image = Image.open(self.paths[idx]).convert('RGB')
 
         if self.transform:
             image = self.transform(image)
 
-        return img_id, image, torch.tensor(label, dtype=torch.long)
\ No newline at end of file
+        return str(self.ids[idx]), image, torch.tensor(self.labels[idx])
\ No newline at end of file
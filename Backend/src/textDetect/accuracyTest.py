@@ -1,10 +1,11 @@
-import json
-import pandas as pd
+from itertools import islice
+
 from fuzzywuzzy import fuzz, process
 from textDetect.image_processor import ImagePreprocessor
 from textDetect.text_extractor2 import TextExtractor
+from textDetect.catalog import load_catalog
+from textDetect.manifest import iter_manifest
 import matplotlib.pyplot as plt
-import ast
 import cv2 
 
 class CardMatcher:
@@ -14,19 +15,14 @@ class CardMatcher:
         self.image_dataset_path = image_dataset_path
         self.match_threshold = match_threshold
         self.card_attributes = self.load_card_attributes()
-        self.image_dataset = self.load_image_dataset()
 
     def load_card_attributes(self):
-        data = pd.read_csv(self.card_attributes_path)
-        list_dict_fields = ['types', 'subtypes', 'evolvesTo', 'abilities', 'attacks', 'weaknesses', 'retreatCost', 'nationalPokedexNumbers', 'resistances', 'rules']
-        for field in list_dict_fields:
-            data[field] = data[field].apply(lambda x: ast.literal_eval(x) if pd.notna(x) else None)
-        return data
+        # Compiled catalog (built from the CSV on first use) instead of re-parsing it
+        return load_catalog(self.card_attributes_path).to_dataframe()
 
     def load_image_dataset(self):
-        with open(self.image_dataset_path, 'r') as file:
-            data = json.load(file)
-        return pd.DataFrame(data)
+        # Streamed one entry at a time, the manifest is never held in memory whole
+        return iter_manifest(self.image_dataset_path)
 
     def match_text(self, extracted_text, actual_text):
         if extracted_text and actual_text:
@@ -35,7 +31,7 @@ class CardMatcher:
             return match is not None
         return False
 
-    def compare_attacks_abilities(self, ocr_text, card_data):
+    def compare_attacks_abilities(self, ocr_text, card_data, first_only=False):
 
         # Initialize empty list to collect possible matches
         possible_matches = []
@@ -47,6 +43,8 @@ class CardMatcher:
                 possible_matches.append(attack)
             if 'text' in attack and isinstance(attack['text'], str) and self.match_text(ocr_text, attack['text']):
                 possible_matches.append(attack)
+            if first_only and possible_matches:
+                return possible_matches
 
         # Check abilities
         for ability in card_data['abilities'] if card_data['abilities'] is not None else []:
@@ -55,12 +53,14 @@ class CardMatcher:
                 possible_matches.append(ability)
             if 'text' in ability and isinstance(ability['text'], str) and self.match_text(ocr_text, ability['text']):
                 possible_matches.append(ability)
+            if first_only and possible_matches:
+                return possible_matches
 
         return possible_matches
     
     def identify_card(self, image_path):
         preprocessor = ImagePreprocessor()
-        processed_image, name_region, hp_region, moves_region = preprocessor.isolate_regions(image_path)
+        processed_image, name_region, hp_region, moves_region, _ = preprocessor.isolate_regions(image_path)
 
         # plt.figure(figsize=(10, 10))
         # plt.imshow(processed_image, cmap='gray')  # Display the image in grayscale
@@ -82,13 +82,13 @@ class CardMatcher:
 
 
         # Match against the card attributes
+        # Name first, then HP, then moves, skipping to the next card as soon as one fails
         for index, card in self.card_attributes.iterrows():  # Fixed reference to the correct dataset
-
-            name_match = self.match_text(ocr_name, card['name'])
-            hp_match = self.match_text(ocr_hp, str(card['hp']))
-            moves_match = self.compare_attacks_abilities(ocr_moves, card)
-
-            if name_match and hp_match and moves_match:
+            if not self.match_text(ocr_name, card['name']):
+                continue
+            if not self.match_text(ocr_hp, str(card['hp'])):
+                continue
+            if self.compare_attacks_abilities(ocr_moves, card, first_only=True):
                 return card  # Return the matching card
 
         return None  # Return None if no match found
@@ -100,9 +100,9 @@ class CardMatcher:
         results = []
 
         # If max_images is specified, limit the number of images processed
-        image_data_subset = self.image_dataset.head(max_images) if max_images else self.image_dataset
+        image_data_subset = islice(self.load_image_dataset(), max_images)
 
-        for index, data in image_data_subset.iterrows():
+        for data in image_data_subset:
             image_path = data['image_path']
 
             card = self.identify_card(image_path)
@@ -122,7 +122,8 @@ class CardMatcher:
     def run(self, max_images=None):
         self.validate_cards(max_images)
 
-# Example usage
-identifier = CardMatcher('PokemonCards/cardAttributes/cardAttributes.csv', 'PokemonCards/downloaded_images/dataset.json')
-# Specify how many images you want to test, for example, 10
-identifier.run(max_images=100)
\ No newline at end of file
+# Example usage, see Backend/evaluate.py for the parallel evaluation with timings
+if __name__ == '__main__':
+    identifier = CardMatcher('PokemonCards/cardAttributes/cardAttributes.csv', 'PokemonCards/downloaded_images/dataset.jsonl')
+    # Specify how many images you want to test, for example, 10
+    identifier.run(max_images=100)
\ No newline at end of file
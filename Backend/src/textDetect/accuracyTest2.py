@@ -1,7 +1,8 @@
-import json
+from itertools import islice
 from fuzzywuzzy import process
 from textDetect.data_processor import ImageDownloader
 from textDetect.image_processor import ImagePreprocessor
+from textDetect.manifest import iter_manifest
 from textDetect.text_extractor2 import TextExtractor
 
 
@@ -11,8 +12,7 @@ class CardMatcher:
         self.match_threshold = match_threshold
 
     def load_data(self):
-        with open(self.dataset_path, 'r') as file:
-            return json.load(file)
+        return iter_manifest(self.dataset_path)
 
     def match_text(self, extracted_text, actual_text):
         if extracted_text and actual_text:
@@ -24,10 +24,10 @@ class CardMatcher:
         results = []
         preprocessor = ImagePreprocessor()
         total_matches = 0
-        for data in dataset[:100]:
+        for data in islice(dataset, 100):
             image_path = data['image_path']  # Ensure this is a valid path to an image file
 
-            processed_image, name_region, hp_region, moves_region = preprocessor.isolate_regions(image_path)
+            processed_image, name_region, hp_region, moves_region, _ = preprocessor.isolate_regions(image_path)
 
             # Extract text from regions
             ocr_name = TextExtractor.extract_text_from_name(name_region)
@@ -65,6 +65,7 @@ class CardMatcher:
         self.validate_cards(dataset)
 
 # Example usage
-# Assuming 'dataset.json' is in your 'PokemonCards/downloaded_images' directory
-matcher = CardMatcher('PokemonCards/downloaded_images/dataset.json')
-matcher.run()
\ No newline at end of file
+# Assuming 'dataset.jsonl' is in your 'PokemonCards/downloaded_images' directory
+if __name__ == '__main__':
+    matcher = CardMatcher('PokemonCards/downloaded_images/dataset.jsonl')
+    matcher.run()
\ No newline at end of file
@@ -0,0 +1,125 @@
+import math
+import re
+from collections import Counter, defaultdict
+
+
+class CardIndex:
+    """
+    Candidate retrieval for CardIdentifier. Card names are indexed with
+    character n-gram postings, so a lookup only fuzzy-matches the names that
+    can still reach the match threshold, and then only the HPs of the rows
+    those names leave, instead of every row of the catalog.
+    """
+
+    def __init__(self, names, hps, match_threshold=90, ngram_size=3):
+        self.match_threshold = match_threshold
+        self.ngram_size = ngram_size
+
+        # Distinct names and the rows that carry them
+        self.name_keys = []
+        self.name_rows = []
+        self.name_lengths = []
+        self.keys_by_length = defaultdict(list)
+        self.unindexed_keys = []
+        self.postings = defaultdict(list)
+
+        # HP of each row, keyed the same way the linear scan compared them: str(hp)
+        self.row_hps = [str(hp) for hp in hps]
+
+        key_for_name = {}
+        for row, name in enumerate(names):
+            key = key_for_name.get(name)
+            if key is None:
+                key = len(self.name_keys)
+                key_for_name[name] = key
+                self.name_keys.append(name)
+                self.name_rows.append([])
+                self.add_name(key, name)
+            self.name_rows[key].append(row)
+
+    @staticmethod
+    def process(text):
+        # Same normalisation rapidfuzz's default_process applies before scoring
+        return re.sub(r'(?u)[\W_]', ' ', text).lower().strip()
+
+    def ngrams(self, text):
+        q = self.ngram_size
+        return Counter(text[i:i + q] for i in range(len(text) - q + 1))
+
+    def add_name(self, key, name):
+        if not isinstance(name, str):
+            # Anything that isn't a string is left for the matcher to reject
+            self.name_lengths.append(None)
+            self.unindexed_keys.append(key)
+            return
+        processed = self.process(name)
+        self.name_lengths.append(len(processed))
+        self.keys_by_length[len(processed)].append(key)
+        for gram, count in self.ngrams(processed).items():
+            self.postings[gram].append((key, count))
+
+    def min_shared_ngrams(self, length):
+        """
+        Lower bound on the n-grams two strings must share for partial_ratio to
+        reach the threshold, where length is the shorter processed string.
+        Every unmatched character in the best alignment breaks at most
+        ngram_size n-grams of the shorter string, so anything below this
+        bound can never match. A bound <= 0 means the length is too short to
+        prune on.
+        """
+        ratio = (self.match_threshold - 0.5) / 100
+        if ratio <= 0:
+            return 0
+        q = self.ngram_size
+        unmatched = math.floor(2 * length * (1 - ratio) / ratio + 1e-9)
+        return (length - q + 1) - q * unmatched
+
+    def name_candidates(self, ocr_name):
+        """ Distinct name keys that may match ocr_name, before fuzzy scoring. """
+        query = self.process(ocr_name)
+        shared = Counter()
+        for gram, count in self.ngrams(query).items():
+            for key, key_count in self.postings.get(gram, ()):
+                shared[key] += min(count, key_count)
+
+        keys = set(self.unindexed_keys)
+        for key, count in shared.items():
+            if count >= self.min_shared_ngrams(min(len(query), self.name_lengths[key])):
+                keys.add(key)
+        # Names sharing no n-gram at all survive only when they are too short to prune
+        for length, length_keys in self.keys_by_length.items():
+            if self.min_shared_ngrams(min(len(query), length)) <= 0:
+                keys.update(length_keys)
+        return keys
+
+    def candidates(self, ocr_name, ocr_hp, matcher, survivors=None):
+        """
+        Returns the catalog rows, in catalog order, whose name and HP both
+        match according to matcher. This is the same set of rows the linear
+        scan accepts on name and HP, so only these need the attack/ability
+        comparison. The filters run as a cascade: names first, then only the
+        HPs of the rows whose name matched. survivors, if given, gets the
+        number of rows left after each stage.
+        """
+        survivors = {} if survivors is None else survivors
+        survivors['catalog'] = len(self.row_hps)
+        survivors['name'] = survivors['hp'] = 0
+        if not ocr_name or not ocr_hp:
+            return []
+
+        keys = sorted(self.name_candidates(ocr_name))
+        names = [self.name_keys[key] for key in keys]
+        rows = []
+        for key, hit in zip(keys, matcher.match_mask(ocr_name, names)):
+            if hit:
+                rows.extend(self.name_rows[key])
+        survivors['name'] = len(rows)
+        if not rows:
+            return []
+
+        # Each distinct HP among the survivors is scored once
+        hp_keys = sorted({self.row_hps[row] for row in rows})
+        hp_hits = {hp for hp, hit in zip(hp_keys, matcher.match_mask(ocr_hp, hp_keys)) if hit}
+        rows = sorted(row for row in rows if self.row_hps[row] in hp_hits)
+        survivors['hp'] = len(rows)
+        return rows
@@ -0,0 +1,215 @@
+import argparse
+import ast
+import fcntl
+import glob
+import json
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+# Columns of cardAttributes.csv stored as Python literals
+LIST_DICT_FIELDS = ['types', 'subtypes', 'evolvesTo', 'abilities', 'attacks', 'weaknesses', 'retreatCost', 'nationalPokedexNumbers', 'resistances', 'rules']
+
+CATALOG_VERSION = 1
+
+
+def read_card_attributes(csv_path):
+    """ Parses cardAttributes.csv, evaluating the list/dict columns. This is the slow path. """
+    data = pd.read_csv(csv_path)
+    for field in LIST_DICT_FIELDS:
+        data[field] = data[field].apply(lambda x: ast.literal_eval(x) if pd.notna(x) else None)
+    return data
+
+
+def default_catalog_dir(csv_path):
+    return os.path.splitext(csv_path)[0] + '.catalog'
+
+
+def iter_move_texts(card):
+    # Attack/ability names and texts in the order CardIdentifier compares them
+    for field in ('attacks', 'abilities'):
+        for entry in card.get(field) or []:
+            for key in ('name', 'text'):
+                if key in entry and isinstance(entry[key], str):
+                    yield entry[key]
+
+
+def write_string_column(catalog_dir, name, values):
+    # UTF-8 blob + byte offsets, with a mask for missing values
+    encoded = [value.encode('utf-8') if isinstance(value, str) else b'' for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    nulls = np.array([not isinstance(value, str) for value in values], dtype=bool)
+    np.save(os.path.join(catalog_dir, f'{name}.data.npy'), np.frombuffer(b''.join(encoded), dtype=np.uint8))
+    np.save(os.path.join(catalog_dir, f'{name}.offsets.npy'), offsets)
+    np.save(os.path.join(catalog_dir, f'{name}.nulls.npy'), nulls)
+
+
+@contextmanager
+def catalog_lock(catalog_dir):
+    """ Held while compiling catalog_dir, so processes starting together compile it once. """
+    with open(catalog_dir + '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def swap_in(version_dir, catalog_dir):
+    """
+    Points catalog_dir, a symlink, at version_dir in one atomic rename, then
+    deletes the versions older than the one it replaced. Processes that have
+    the old files mapped keep reading them.
+    """
+    previous = os.path.realpath(catalog_dir) if os.path.islink(catalog_dir) else None
+    if os.path.isdir(catalog_dir) and not os.path.islink(catalog_dir):
+        # A catalog compiled before versions were kept, moved aside once
+        previous = catalog_dir + '.legacy'
+        shutil.rmtree(previous, ignore_errors=True)
+        os.rename(catalog_dir, previous)
+
+    link_path = f'{catalog_dir}.link-{os.getpid()}'
+    os.symlink(os.path.basename(version_dir), link_path)
+    os.replace(link_path, catalog_dir)
+
+    for path in glob.glob(glob.escape(catalog_dir) + '.*'):
+        if os.path.isdir(path) and not os.path.islink(path) and os.path.realpath(path) not in (os.path.realpath(version_dir), previous):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def write_catalog(csv_path, catalog_dir):
+    # Callers hold catalog_lock
+    data = read_card_attributes(csv_path)
+    records = data.astype(object).where(pd.notna(data), None).to_dict('records')
+
+    move_texts = []
+    move_offsets = np.zeros(len(records) + 1, dtype=np.int64)
+    for i, card in enumerate(records):
+        move_texts.extend(iter_move_texts(card))
+        move_offsets[i + 1] = len(move_texts)
+
+    # Build a new version next to the target and swap it in, so readers never see a partial catalog
+    version_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(catalog_dir)), prefix=os.path.basename(catalog_dir) + '.')
+    try:
+        os.chmod(version_dir, 0o755)
+        write_string_column(version_dir, 'name', list(data['name']))
+        # A non-numeric HP is stored as NaN, like a missing one
+        np.save(os.path.join(version_dir, 'hp.npy'), pd.to_numeric(data['hp'], errors='coerce').to_numpy(dtype=np.float64))
+        write_string_column(version_dir, 'move_text', move_texts)
+        np.save(os.path.join(version_dir, 'move_offsets.npy'), move_offsets)
+        write_string_column(version_dir, 'record', [json.dumps(record) for record in records])
+        with open(os.path.join(version_dir, 'meta.json'), 'w') as file:
+            json.dump({'version': CATALOG_VERSION, 'source': os.path.abspath(csv_path), 'cards': len(records)}, file)
+    except BaseException:
+        shutil.rmtree(version_dir, ignore_errors=True)
+        raise
+    swap_in(version_dir, catalog_dir)
+    return catalog_dir
+
+
+def compile_catalog(csv_path, catalog_dir=None):
+    """
+    Compiles cardAttributes.csv into a directory of flat .npy columns that
+    CardCatalog memory-maps. Card names, HPs and the flattened attack/ability
+    texts (with per-card offsets) are stored for matching; every row is also
+    kept as a JSON record so a matched card can be returned in full.
+    """
+    catalog_dir = catalog_dir or default_catalog_dir(csv_path)
+    with catalog_lock(catalog_dir):
+        return write_catalog(csv_path, catalog_dir)
+
+
+class StringColumn:
+    def __init__(self, catalog_dir, name):
+        self.data = np.load(os.path.join(catalog_dir, f'{name}.data.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(catalog_dir, f'{name}.offsets.npy'), mmap_mode='r')
+        self.nulls = np.load(os.path.join(catalog_dir, f'{name}.nulls.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if self.nulls[i]:
+            return None
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+
+    def slice(self, start, end):
+        return [self[i] for i in range(start, end)]
+
+    def tolist(self):
+        return self.slice(0, len(self))
+
+
+class CardCatalog:
+    """
+    Read-only view of a compiled card catalog. All columns are memory-mapped,
+    so opening is cheap and worker processes share the same pages.
+    """
+
+    def __init__(self, catalog_dir):
+        # Every column from the same version, even if a new one is swapped in meanwhile
+        catalog_dir = os.path.realpath(catalog_dir)
+        self.catalog_dir = catalog_dir
+        with open(os.path.join(catalog_dir, 'meta.json')) as file:
+            self.meta = json.load(file)
+        if self.meta.get('version') != CATALOG_VERSION:
+            raise ValueError(f"Catalog {catalog_dir} has version {self.meta.get('version')}, expected {CATALOG_VERSION}; recompile it.")
+
+        self.name = StringColumn(catalog_dir, 'name')
+        self.hp = np.load(os.path.join(catalog_dir, 'hp.npy'), mmap_mode='r')
+        self.move_text = StringColumn(catalog_dir, 'move_text')
+        self.move_offsets = np.load(os.path.join(catalog_dir, 'move_offsets.npy'), mmap_mode='r')
+        self.records = StringColumn(catalog_dir, 'record')
+
+    def __len__(self):
+        return len(self.name)
+
+    def move_texts(self, i):
+        """ Attack/ability names and texts of card i. """
+        return self.move_text.slice(self.move_offsets[i], self.move_offsets[i + 1])
+
+    def record(self, i):
+        """ Full attribute dict of card i. """
+        return json.loads(self.records[i])
+
+    def to_dataframe(self):
+        return pd.DataFrame([self.record(i) for i in range(len(self))])
+
+
+def is_stale(csv_path, catalog_dir):
+    meta_path = os.path.join(catalog_dir, 'meta.json')
+    if not os.path.exists(meta_path):
+        return True
+    return os.path.exists(csv_path) and os.path.getmtime(csv_path) > os.path.getmtime(meta_path)
+
+
+def load_catalog(csv_path, catalog_dir=None):
+    """ Opens the compiled catalog for csv_path, compiling it first if it is missing or stale. """
+    catalog_dir = catalog_dir or default_catalog_dir(csv_path)
+    if is_stale(csv_path, catalog_dir):
+        with catalog_lock(catalog_dir):
+            # Another process may have compiled it while this one waited
+            if is_stale(csv_path, catalog_dir):
+                write_catalog(csv_path, catalog_dir)
+    try:
+        return CardCatalog(catalog_dir)
+    except ValueError:
+        with catalog_lock(catalog_dir):
+            try:
+                return CardCatalog(catalog_dir)
+            except ValueError:
+                write_catalog(csv_path, catalog_dir)
+        return CardCatalog(catalog_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compile cardAttributes.csv into a memory-mapped card catalog.')
+    parser.add_argument('csv_path', nargs='?', default='PokemonCards/cardAttributes/cardAttributes.csv')
+    parser.add_argument('--output', default=None, help='Catalog directory (default: next to the CSV)')
+    args = parser.parse_args()
+    print(f"Catalog written to {compile_catalog(args.csv_path, args.output)}")
@@ -1 +1,10 @@
-path_debug = "../debug"
\ No newline at end of file
+path_debug = "../debug"
+
+# Size every extracted card is normalized to, as (width, height)
+card_size = (600, 825)
+
+# Regions of the normalized card, as (x1, y1, x2, y2)
+name_region_coords = (5, 0, 400, 90)
+hp_region_coords = (400, 0, 600, 90)
+move_region_coords = (10, 420, 590, 730)
+set_symbol_region_coords = (10, 730, 590, 825)
@@ -1,58 +1,143 @@
 import os
 import csv
-import json
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+from urllib.parse import urlsplit
+
 import requests
-from PIL import Image
-from io import BytesIO
+from requests.adapters import HTTPAdapter
+
+from textDetect.manifest import ManifestWriter, manifest_ids, migrate_json_manifest
+
+# File extension of each image type the servers send
+IMAGE_EXTENSIONS = {'image/png': '.png', 'image/jpeg': '.jpg', 'image/webp': '.webp', 'image/gif': '.gif'}
 
 class ImageDownloader:
-    def __init__(self, dataset_path, download_dir='PokemonCards/downloaded_images'):
+    """
+    Downloads the card images listed in a dataset CSV with a pool of threads.
+    Each thread keeps its own requests.Session, so connections are reused, and
+    at most per_host_limit requests run against one host at a time. Every
+    finished download is appended to the dataset.jsonl manifest, which lets
+    an interrupted run pick up where it stopped.
+    """
+
+    def __init__(self, dataset_path, download_dir='PokemonCards/downloaded_images', workers=16, per_host_limit=8, timeout=20):
         self.dataset_path = dataset_path
         self.download_dir = download_dir
+        self.workers = workers
+        self.per_host_limit = per_host_limit
+        self.timeout = timeout
         os.makedirs(self.download_dir, exist_ok=True)
 
+        self.manifest_path = os.path.join(self.download_dir, 'dataset.jsonl')
+        self.sessions = threading.local()
+        self.host_limits = {}
+        self.host_limits_lock = threading.Lock()
+
+    def session(self):
+        # One session per thread: requests.Session isn't thread-safe, but its connection pool is reused across calls
+        session = getattr(self.sessions, 'session', None)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=self.per_host_limit, pool_maxsize=self.per_host_limit)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self.sessions.session = session
+        return session
+
+    def host_limit(self, url):
+        host = urlsplit(url).netloc
+        with self.host_limits_lock:
+            if host not in self.host_limits:
+                self.host_limits[host] = threading.BoundedSemaphore(self.per_host_limit)
+            return self.host_limits[host]
+
+    def existing_image(self, image_id):
+        # A finished download of image_id, whatever type the server sent
+        for extension in ('.png', '.jpg', '.jpeg', '.webp', '.gif'):
+            image_path = os.path.join(self.download_dir, f"{image_id}{extension}")
+            if os.path.exists(image_path) and os.path.getsize(image_path) > 0:
+                return image_path
+        return None
+
+    @staticmethod
+    def image_extension(response, url):
+        # The Content-Type the server sent, else the extension of the URL, else .png
+        content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+        if content_type in IMAGE_EXTENSIONS:
+            return IMAGE_EXTENSIONS[content_type]
+        extension = os.path.splitext(urlsplit(url).path)[1].lower()
+        if extension == '.jpeg' or extension in IMAGE_EXTENSIONS.values():
+            return extension
+        return '.png'
+
     def download_image(self, url, image_id):
+        """
+        Saves the image at url as <image_id> with the extension of its type,
+        byte for byte, and returns its path. Files already on disk are not
+        downloaded again. Returns None if the download fails.
+        """
+        image_path = self.existing_image(image_id)
+        if image_path:
+            return image_path
+        tmp_path = os.path.join(self.download_dir, f"{image_id}.part")
         try:
-            # print(f"Attempting to download image {image_id} from {url}")
-            response = requests.get(url, timeout=20)
-            response.raise_for_status()
-            image = Image.open(BytesIO(response.content))
-            image_path = os.path.join(self.download_dir, f"{image_id}.png")
-            image.save(image_path)
-            # print(f"Successfully downloaded {image_id}")
+            with self.host_limit(url):
+                with self.session().get(url, timeout=self.timeout, stream=True) as response:
+                    response.raise_for_status()
+                    image_path = os.path.join(self.download_dir, f"{image_id}{self.image_extension(response, url)}")
+                    with open(tmp_path, 'wb') as file:
+                        for chunk in response.iter_content(chunk_size=64 * 1024):
+                            file.write(chunk)
+            # Only complete files get the final name, so a crash mid-download is retried on the next run
+            os.replace(tmp_path, image_path)
             return image_path
-        except requests.RequestException as e:
+        except (requests.RequestException, OSError) as e:
             print(f"Error downloading {url}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
             return None
 
+    def download_row(self, row, manifest):
+        image_path = self.download_image(row['image_url'], row['id'])
+        if not image_path:
+            return None
+        image_data = {
+            'id': row['id'],
+            'image_path': image_path,
+            'caption': row['caption'],
+            'name': row['name'],
+            'hp': row['hp'],
+            'set_name': row['set_name']
+        }
+        manifest.append(image_data)
+        return image_data
+
     def load_dataset_images(self, max_images=17000):
-        dataset_file_path = os.path.join(self.download_dir, 'dataset.json')
-        existing_dataset = []
-
-        # Load existing dataset if it exists
-        if os.path.exists(dataset_file_path):
-            with open(dataset_file_path, 'r') as file:
-                existing_dataset = json.load(file)
-
-        with open(self.dataset_path, 'r') as file:
-            reader = csv.DictReader(file)
-            for row in reader:
-                image_path = self.download_image(row['image_url'], row['id'])
-                if image_path:
-                    image_data = {
-                        'id': row['id'],
-                        'image_path': image_path,
-                        'caption': row['caption'],
-                        'name': row['name'],
-                        'hp': row['hp'],
-                        'set_name': row['set_name']
-                    }
-                    existing_dataset.append(image_data)
-                if max_images and len(existing_dataset) >= max_images:
-                    break
-
-        # Save the updated dataset
-        with open(dataset_file_path, 'w') as file:
-            json.dump(existing_dataset, file)
-
-        return existing_dataset
\ No newline at end of file
+        """
+        Downloads the images of the dataset CSV that aren't in the manifest yet,
+        streaming both the CSV and the manifest. Returns the number of entries
+        in the manifest afterwards.
+        """
+        # Runs from before the manifest was JSON Lines wrote a whole-file dataset.json
+        migrate_json_manifest(os.path.join(self.download_dir, 'dataset.json'), self.manifest_path)
+        done = manifest_ids(self.manifest_path)
+        downloaded = len(done)
+
+        with open(self.dataset_path, 'r') as file, ManifestWriter(self.manifest_path) as manifest, \
+                ThreadPoolExecutor(max_workers=self.workers) as executor:
+            rows = (row for row in csv.DictReader(file) if row['id'] not in done)
+            if max_images:
+                rows = islice(rows, max(max_images - downloaded, 0))
+            # A bounded window of downloads in flight, refilled as each one finishes, so memory
+            # doesn't grow with the size of the CSV and a slow download never stalls the others
+            pending = set()
+            for row in rows:
+                if len(pending) >= self.workers * 4:
+                    done_futures, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    downloaded += sum(1 for future in done_futures if future.result())
+                pending.add(executor.submit(self.download_row, row, manifest))
+            downloaded += sum(1 for future in pending if future.result())
+
+        return downloaded
@@ -0,0 +1,56 @@
+import itertools
+import os
+import queue
+import re
+import threading
+
+import cv2
+
+
+class DebugImageWriter:
+    """
+    Writes annotated debug images to a directory from a background thread, so
+    the pipeline never blocks on plotting or disk I/O. Only created when debug
+    visualisation is turned on.
+    """
+
+    # One writer (and thread) per output directory
+    writers = {}
+    writers_lock = threading.Lock()
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        os.makedirs(output_dir, exist_ok=True)
+        self.queue = queue.Queue()
+        self.counter = itertools.count()
+        self.thread = threading.Thread(target=self.run, name='debug-image-writer', daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def for_dir(cls, output_dir):
+        with cls.writers_lock:
+            if output_dir not in cls.writers:
+                cls.writers[output_dir] = cls(output_dir)
+            return cls.writers[output_dir]
+
+    def save(self, title, image):
+        # Copy now, the caller may keep modifying the array
+        self.queue.put((next(self.counter), title, image.copy()))
+
+    def flush(self):
+        """ Blocks until every queued image has been written. """
+        self.queue.join()
+
+    def run(self):
+        while True:
+            index, title, image = self.queue.get()
+            try:
+                if len(image.shape) == 2:
+                    image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+                cv2.putText(image, title, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2, cv2.LINE_AA)
+                filename = f"{index:06d}_{re.sub(r'[^A-Za-z0-9]+', '_', title).strip('_')}.png"
+                cv2.imwrite(os.path.join(self.output_dir, filename), image)
+            except cv2.error as e:
+                print(f"Error writing debug image {title}: {e}")
+            finally:
+                self.queue.task_done()
@@ -0,0 +1,35 @@
+import numpy as np
+from rapidfuzz import fuzz, process, utils
+
+
+class FuzzyMatcher:
+    """
+    Batched fuzzy scoring on top of rapidfuzz. One call scores OCR strings
+    against a whole column of catalog strings in C instead of paying a Python
+    extractOne call per card, field and attack.
+    """
+
+    def __init__(self, match_threshold=90, scorer=fuzz.partial_ratio, workers=1):
+        self.match_threshold = match_threshold
+        self.scorer = scorer
+        self.workers = workers
+
+    def score_matrix(self, queries, choices):
+        """
+        Returns a (len(queries), len(choices)) float32 matrix of scores. Scores
+        below the threshold are cut off early and come back as 0.
+        """
+        if len(queries) == 0 or len(choices) == 0:
+            return np.zeros((len(queries), len(choices)), dtype=np.float32)
+
+        # Anything that isn't a string (NaN, None) can never match
+        choices = [choice if isinstance(choice, str) else '' for choice in choices]
+        return process.cdist(queries, choices, scorer=self.scorer, processor=utils.default_process,
+                             score_cutoff=self.match_threshold, dtype=np.float32, workers=self.workers)
+
+    def match_mask(self, query, choices):
+        """ Boolean mask of the choices that query matches. """
+        if not query:
+            return np.zeros(len(choices), dtype=bool)
+        scores = self.score_matrix([query], choices)[0]
+        return (scores >= self.match_threshold) & (scores > 0)
@@ -5,24 +5,19 @@ from skimage.transform import (hough_line, hough_line_peaks)
 from fuzzywuzzy import fuzz, process
 from textDetect.image_processor import ImagePreprocessor
 from textDetect.text_extractor2 import TextExtractor
-import matplotlib.pyplot as plt
-import ast
+from textDetect.catalog import load_catalog
 
 class CardIdentifier:
 
-    def __init__(self, dataset_path, match_threshold=90):
+    def __init__(self, dataset_path, match_threshold=90, debug=False):
         self.dataset_path = dataset_path
         self.match_threshold = match_threshold
+        self.debug = debug
         self.dataset = self.load_data()  # Load data during initialization
 
     def load_data(self):
-        # Load the CSV directly into a pandas DataFrame
-        data = pd.read_csv(self.dataset_path)
-        # Convert string representations of lists, dictionaries safely to Python objects
-        list_dict_fields = ['types', 'subtypes', 'evolvesTo', 'abilities', 'attacks', 'weaknesses', 'retreatCost', 'nationalPokedexNumbers', 'resistances', 'rules']
-        for field in list_dict_fields:
-            data[field] = data[field].apply(lambda x: ast.literal_eval(x) if pd.notna(x) else None)
-        return data
+        # Compiled catalog (built from the CSV on first use) instead of re-parsing it
+        return load_catalog(self.dataset_path).to_dataframe()
 
     def match_text(self, extracted_text, actual_text):
         if extracted_text and actual_text:
@@ -31,7 +26,7 @@ class CardIdentifier:
             return match is not None
         return False
 
-    def compare_attacks_abilities(self, ocr_text, card_data):
+    def compare_attacks_abilities(self, ocr_text, card_data, first_only=False):
         # Initialize empty list to collect possible matches
         possible_matches = []
 
@@ -42,6 +37,8 @@ class CardIdentifier:
                 possible_matches.append(attack)
             if 'text' in attack and isinstance(attack['text'], str) and self.match_text(ocr_text, attack['text']):
                 possible_matches.append(attack)
+            if first_only and possible_matches:
+                return possible_matches
 
         # Check abilities
         for ability in card_data['abilities'] if card_data['abilities'] is not None else []:
@@ -50,23 +47,18 @@ class CardIdentifier:
                 possible_matches.append(ability)
             if 'text' in ability and isinstance(ability['text'], str) and self.match_text(ocr_text, ability['text']):
                 possible_matches.append(ability)
+            if first_only and possible_matches:
+                return possible_matches
 
         return possible_matches
 
-    def identify_card(self, image_path):
-        preprocessor = ImagePreprocessor()
-        processed_image, name_region, hp_region, moves_region, _ = preprocessor.isolate_regions(image_path)
+    def identify_card(self, image):
+        # Debug images (including the regions) are written by the preprocessor
+        preprocessor = ImagePreprocessor(debug=self.debug)
+        processed_image, name_region, hp_region, moves_region, _ = preprocessor.isolate_regions(image)
 
-        # Display processed regions
-        plt.figure(figsize=(10, 10))
-        plt.imshow(cv2.cvtColor(processed_image, cv2.COLOR_BGR2RGB))
-        plt.title('Processed Image with Defined Regions')
-        plt.show()
-
-        # Extract text
-        ocr_name = TextExtractor.extract_text_from_name(name_region)
-        ocr_hp = TextExtractor.extract_text_from_hp(hp_region)
-        ocr_moves = TextExtractor.extract_text_from_moves(moves_region)
+        # Extract text, one OCR pass over the whole card for all three regions
+        ocr_name, ocr_hp, ocr_moves = TextExtractor.extract_text_from_card(processed_image)
 
         # Post-process text for better matching
         ocr_name = TextExtractor.post_process_text(ocr_name)
@@ -76,19 +68,27 @@ class CardIdentifier:
         print("Extracted HP Text:", TextExtractor.post_process_hp_text(ocr_hp))
         print("Extracted Move Text:", TextExtractor.post_process_text(ocr_moves))
 
-        # Attempt to match text with dataset entries
+        # Cascade: the name filter runs on every row, HP only on rows whose name matched,
+        # and moves only on rows that passed both, stopping at the first matching attack/ability
+        survivors = {'catalog': len(self.dataset), 'name': 0, 'hp': 0, 'moves': 0}
         for index, card in self.dataset.iterrows():
-            name_match = self.match_text(ocr_name, card['name'])
-            hp_match = self.match_text(ocr_hp, str(card['hp']))
-            matches = self.compare_attacks_abilities(ocr_moves, card)
-            if name_match and hp_match and matches:
+            if not self.match_text(ocr_name, card['name']):
+                continue
+            survivors['name'] += 1
+            if not self.match_text(ocr_hp, str(card['hp'])):
+                continue
+            survivors['hp'] += 1
+            if self.compare_attacks_abilities(ocr_moves, card, first_only=True):
+                survivors['moves'] += 1
+                print("Cascade survivors:", survivors)
                 print(f"Identified Card: {card['name']} (ID: {card['id']})")
                 return card['id']
 
+        print("Cascade survivors:", survivors)
         print("No matching card found.")
         return None
 
 # Example usage
-identifier = CardIdentifier('PokemonCards/cardAttributes/cardAttributes.csv')
+identifier = CardIdentifier('PokemonCards/cardAttributes/cardAttributes.csv', debug=True)
 result = identifier.identify_card('PokemonCards/testImage/test.jpg')
 print(f"Identified Card ID: {result}")
\ No newline at end of file
@@ -1,13 +1,43 @@
 import cv2
 import numpy as np
-import matplotlib.pyplot as plt
 import math
-from collections import defaultdict
 import sys
 import os
+from textDetect.constants import path_debug, card_size, name_region_coords, hp_region_coords, move_region_coords, set_symbol_region_coords
+from textDetect.debug_writer import DebugImageWriter
+from textDetect.tracing import stage
 
 class ImagePreprocessor:
 
+    def __init__(self, debug=False, debug_dir=path_debug):
+        # Debug images are written to debug_dir in the background; off by default
+        self.debug = debug
+        self.debug_dir = debug_dir
+
+    def debug_image(self, title, image):
+        if self.debug and image is not None:
+            DebugImageWriter.for_dir(self.debug_dir).save(title, image)
+
+    @staticmethod
+    def load_image(source):
+        """
+        Accepts a decoded BGR ndarray, the raw bytes of an encoded image, or a
+        file path. Bytes are decoded in memory with cv2.imdecode. Returns None
+        if the image can't be decoded, raises ValueError on empty bytes.
+        """
+        if source is None or isinstance(source, np.ndarray):
+            return source
+        with stage('decode'):
+            if isinstance(source, (bytes, bytearray, memoryview)):
+                # cv2.imdecode raises cv2.error rather than returning None on an empty buffer
+                if len(source) == 0:
+                    raise ValueError("Empty image upload.")
+                try:
+                    return cv2.imdecode(np.frombuffer(source, dtype=np.uint8), cv2.IMREAD_COLOR)
+                except cv2.error as e:
+                    raise ValueError(f"Unable to decode image: {e}")
+            return cv2.imread(source)
+
     @staticmethod
     def order_points(pts):
         # Initial ordering of points
@@ -66,46 +96,75 @@ class ImagePreprocessor:
 
     @staticmethod
     def segment_by_angle_kmeans(lines, k=2, **kwargs):
+        """
+        Groups Hough lines (an (N, 1, 2) array of rho, theta) into k groups by
+        angle. Returns one (M, 1, 2) array per group, in order of first line.
+        """
         default_criteria_type = cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER
         criteria = kwargs.get('criteria', (default_criteria_type, 10, 1.0))
         flags = kwargs.get('flags', cv2.KMEANS_RANDOM_CENTERS)
         attempts = kwargs.get('attempts', 10)
-        angles = np.array([line[0][1] for line in lines])
-        pts = np.array([[np.cos(2*angle), np.sin(2*angle)]
-                   for angle in angles], dtype=np.float32)
-        
+        lines = np.asarray(lines, dtype=np.float32).reshape(-1, 1, 2)
+
+        # Doubling the angle maps theta and theta + pi to the same point on the unit circle
+        angles = 2 * lines[:, 0, 1]
+        pts = np.stack([np.cos(angles), np.sin(angles)], axis=1).astype(np.float32)
 
         labels, centers = cv2.kmeans(pts, k, None, criteria, attempts, flags)[1:]
         labels = labels.reshape(-1)
 
-        segmented = defaultdict(list)
-        for i, line in zip(range(len(lines)), lines):
-            segmented[labels[i]].append(line)
-
-        segmented = list(segmented.values())
-
-        return segmented
+        _, first_seen = np.unique(labels, return_index=True)
+        return [lines[labels == labels[i]] for i in np.sort(first_seen)]
 
     @staticmethod
-    def intersection(line1, line2):
-        rho1, theta1 = line1[0]
-        rho2, theta2 = line2[0]
-        A = np.array([[np.cos(theta1), np.sin(theta1)], [np.cos(theta2), np.sin(theta2)]])
-        b = np.array([[rho1], [rho2]])
-        x0, y0 = np.linalg.solve(A, b)
-
-        return [[x0, y0]]
+    def intersections_between(group1, group2, min_det=1e-6):
+        """
+        Intersections of every line of group1 with every line of group2, solved
+        in closed form for all pairs at once. Pairs that are (nearly) parallel
+        are dropped. Returns an (K, 2) array of x, y.
+        """
+        rho1, theta1 = (np.asarray(group1, dtype=np.float64).reshape(-1, 2)[:, None, i] for i in (0, 1))
+        rho2, theta2 = (np.asarray(group2, dtype=np.float64).reshape(-1, 2)[None, :, i] for i in (0, 1))
+        cos1, sin1, cos2, sin2 = np.cos(theta1), np.sin(theta1), np.cos(theta2), np.sin(theta2)
+
+        # Cramer's rule on [[cos1, sin1], [cos2, sin2]] @ [x, y] = [rho1, rho2]
+        det = cos1 * sin2 - sin1 * cos2
+        valid = np.abs(det) > min_det
+        safe_det = np.where(valid, det, 1.0)
+        x = (rho1 * sin2 - rho2 * sin1) / safe_det
+        y = (cos1 * rho2 - cos2 * rho1) / safe_det
+        return np.stack([x[valid], y[valid]], axis=1)
 
     def segmented_intersections(self, lines):
-
-        intersections = []
-        for i, group in enumerate(lines[:-1]):
-            for next_group in lines[i+1:]:
-                for line1 in group:
-                    for line2 in next_group:
-                        intersections.append(self.intersection(line1, line2))
-
-        return intersections
+        """ Intersections between the lines of every pair of groups, as a (K, 1, 2) array. """
+        intersections = [self.intersections_between(group, next_group)
+                         for i, group in enumerate(lines[:-1]) for next_group in lines[i + 1:]]
+        if not intersections:
+            return np.empty((0, 1, 2))
+        return np.concatenate(intersections).reshape(-1, 1, 2)
+
+    def find_corners_hough(self, img, hough_threshold=120):
+        """
+        Fallback for extract_card when there is no contour or the largest one
+        doesn't simplify to four points: the card corners are taken from the intersections of the
+        two dominant line directions in the edge image. Returns a (4, 2) array,
+        or None if no corners can be found.
+        """
+        lines = cv2.HoughLines(self.detect_edge(img), 1, np.pi / 180, hough_threshold)
+        if lines is None or len(lines) < 4:
+            return None
+        points = self.segmented_intersections(self.segment_by_angle_kmeans(lines)).reshape(-1, 2)
+
+        height, width = img.shape[:2]
+        inside = (points[:, 0] >= 0) & (points[:, 0] < width) & (points[:, 1] >= 0) & (points[:, 1] < height)
+        points = points[inside]
+        if len(points) < 4:
+            return None
+
+        # Extreme intersections along the diagonals are the corners, four_point_transform orders them
+        s = points.sum(axis=1)
+        diff = np.diff(points, axis=1).reshape(-1)
+        return points[[np.argmin(s), np.argmin(diff), np.argmax(s), np.argmax(diff)]].astype(np.float32)
 
     def drawLines(self, img, lines, color=(255, 0, 0)):
         for i in range(0, len(lines)):
@@ -120,6 +179,11 @@ class ImagePreprocessor:
             cv2.line(img, pt1, pt2, color, 3, cv2.LINE_AA)
 
 
+    @staticmethod
+    def crop_region(image, coords):
+        x1, y1, x2, y2 = coords
+        return image[y1:y2, x1:x2]
+
     def detect_edge(self, img):
         img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
         img_blurred = cv2.GaussianBlur(img, (5, 5), 0)
@@ -127,89 +191,76 @@ class ImagePreprocessor:
         return canny
 
     def extract_card(self, image):
+        image = self.load_image(image)
         img = image
         if img is None:
-            raise ValueError("Image not found Canny(blurred_img, 50, 200)or unable to load.")
-
-        edged = self.detect_edge(img.copy())
-        
-        # Display processed regions
-        plt.figure(figsize=(10, 10))
-        plt.imshow(cv2.cvtColor(edged, cv2.COLOR_BGR2RGB))
-        plt.title('Edges')
-        plt.show()
-
-        imgray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        ret, thresh = cv2.threshold(imgray, 190, 255, 0)
-
-        contours, hierarchy = cv2.findContours(thresh, cv2.RETR_EXTERNAL,  cv2.CHAIN_APPROX_SIMPLE)
-        sorted_contours = sorted(contours, key=cv2.contourArea, reverse=True)
-
-        largest_item = sorted_contours[0]
-        hull = cv2.convexHull(largest_item)
-        epsilon = 0.02*cv2.arcLength(hull, True)
-        approx = cv2.approxPolyDP(hull, epsilon, True)
-
-        contoured = img.copy()
-
-        cv2.drawContours(contoured, [hull], -1, (255,0,255), 30)
-        # Display processed regions
-        plt.figure(figsize=(10, 10))
-        plt.imshow(cv2.cvtColor(contoured, cv2.COLOR_BGR2RGB))
-        plt.title('Lines')
-        plt.show()
-
-        warped = self.four_point_transform(image, approx.reshape(4, 2))
-
-        plt.figure(figsize=(10, 10))
-        plt.imshow(cv2.cvtColor(warped, cv2.COLOR_BGR2RGB))
-        plt.title('warped')
-        plt.show()
+            raise ValueError("Image not found or unable to load.")
+
+        if self.debug:
+            self.debug_image('Edges', self.detect_edge(img.copy()))
+
+        with stage('edge_detection'):
+            imgray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            ret, thresh = cv2.threshold(imgray, 190, 255, 0)
+
+            contours, hierarchy = cv2.findContours(thresh, cv2.RETR_EXTERNAL,  cv2.CHAIN_APPROX_SIMPLE)
+            sorted_contours = sorted(contours, key=cv2.contourArea, reverse=True)
+
+            # Nothing bright enough to outline (e.g. a dark photo): leave it to the Hough fallback
+            approx = None
+            if sorted_contours:
+                largest_item = sorted_contours[0]
+                hull = cv2.convexHull(largest_item)
+                epsilon = 0.02*cv2.arcLength(hull, True)
+                approx = cv2.approxPolyDP(hull, epsilon, True)
+
+        if self.debug and approx is not None:
+            contoured = img.copy()
+            cv2.drawContours(contoured, [hull], -1, (255,0,255), 30)
+            self.debug_image('Lines', contoured)
+
+        if approx is not None and len(approx) == 4:
+            corners = approx.reshape(4, 2)
+        else:
+            with stage('hough_corners'):
+                corners = self.find_corners_hough(img)
+            if corners is None:
+                raise ValueError("Could not find the corners of the card.")
+
+        with stage('warp'):
+            warped = self.four_point_transform(image, corners)
+        self.debug_image('warped', warped)
 
         return warped
             
 
-    def isolate_regions(self, image_path):
-        image = cv2.imread(image_path)
-
-         # Display processed regions
-        plt.figure(figsize=(10, 10))
-        plt.imshow(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
-        plt.title('Processed Image with Defined Regions')
-        plt.show()
-
+    def isolate_regions(self, image):
+        image = self.load_image(image)
+        self.debug_image('Input', image)
 
         card_image = self.extract_card(image)
-
-        # Display processed regions
-        plt.figure(figsize=(10, 10))
-        plt.imshow(cv2.cvtColor(card_image, cv2.COLOR_BGR2RGB))
-        plt.title('Processed Image with Defined Regions')
-        plt.show()
+        self.debug_image('Card', card_image)
 
 
-        standard_size = (600, 825)  # Example size, adjust as needed
         try:
-            normalized_image = cv2.resize(card_image, standard_size)
+            with stage('resize'):
+                normalized_image = cv2.resize(card_image, card_size)
         except cv2.error as e:
             print(f"Error resizing image: {e}")
-            return None, None, None, None
-
-        name_region_coords = (5, 0, 400, 90)
-        hp_region_coords = (400, 0, 600, 90)
-        move_region_coords = (10, 420, 590, 730)
-        set_symbol_region_coords = (10, 730, 590, 825)  # New region for set symbol
-
-        name_region = normalized_image[0:90, 5:400]
-        hp_region = normalized_image[0:90, 400:600]
-        move_region = normalized_image[420:730, 10:590]
-        set_symbol_region = normalized_image[730:825, 10:590]  # Extracting the new region
-
-
-        cv2.rectangle(normalized_image, name_region_coords[:2], name_region_coords[2:], (255, 0, 0), 2)
-        cv2.rectangle(normalized_image, hp_region_coords[:2], hp_region_coords[2:], (0, 255, 0), 2)
-        cv2.rectangle(normalized_image, move_region_coords[:2], move_region_coords[2:], (0, 0, 255), 2)
-        cv2.rectangle(normalized_image, set_symbol_region_coords[:2], set_symbol_region_coords[2:], (255, 255, 0), 2)  # Drawing the new region
-
+            return None, None, None, None, None
+
+        name_region = self.crop_region(normalized_image, name_region_coords)
+        hp_region = self.crop_region(normalized_image, hp_region_coords)
+        move_region = self.crop_region(normalized_image, move_region_coords)
+        set_symbol_region = self.crop_region(normalized_image, set_symbol_region_coords)
+
+        # Outline the regions on a copy only, the crops above are views into normalized_image
+        if self.debug:
+            annotated = normalized_image.copy()
+            cv2.rectangle(annotated, name_region_coords[:2], name_region_coords[2:], (255, 0, 0), 2)
+            cv2.rectangle(annotated, hp_region_coords[:2], hp_region_coords[2:], (0, 255, 0), 2)
+            cv2.rectangle(annotated, move_region_coords[:2], move_region_coords[2:], (0, 0, 255), 2)
+            cv2.rectangle(annotated, set_symbol_region_coords[:2], set_symbol_region_coords[2:], (255, 255, 0), 2)  # Drawing the new region
+            self.debug_image('Processed Image with Defined Regions', annotated)
 
         return normalized_image, name_region, hp_region, move_region, set_symbol_region
@@ -0,0 +1,80 @@
+import json
+import os
+import threading
+
+
+def iter_manifest(path):
+    """
+    Yields the entries of a JSON Lines manifest one at a time, so memory
+    stays flat however large it grows. A partial last line, left by a run
+    that was killed mid-write, is skipped. Legacy whole-file .json
+    manifests are still read, though not lazily.
+    """
+    if not os.path.exists(path):
+        return
+    if path.endswith('.json'):
+        with open(path, 'r') as file:
+            yield from json.load(file)
+        return
+    with open(path, 'r') as file:
+        for line in file:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+
+def manifest_ids(path):
+    return {entry['id'] for entry in iter_manifest(path)}
+
+
+def count_manifest(path):
+    return sum(1 for _ in iter_manifest(path))
+
+
+class ManifestWriter:
+    """
+    Appends entries to a JSON Lines manifest. Each entry is written and
+    flushed as one line, under a lock, so threads can share a writer and a
+    crash loses at most the entry being written.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # Terminate a partial line left by a crash, so the next entry doesn't run into it
+        ends_cleanly = True
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, 'rb') as file:
+                file.seek(-1, os.SEEK_END)
+                ends_cleanly = file.read(1) == b'\n'
+        self.file = open(path, 'a')
+        if not ends_cleanly:
+            self.file.write('\n')
+
+    def append(self, entry):
+        line = json.dumps(entry) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def migrate_json_manifest(json_path, jsonl_path):
+    """ Converts a legacy dataset.json into a JSON Lines manifest, unless that already exists. """
+    if os.path.exists(json_path) and not os.path.exists(jsonl_path):
+        with ManifestWriter(jsonl_path + '.tmp') as writer:
+            for entry in iter_manifest(json_path):
+                writer.append(entry)
+        os.replace(jsonl_path + '.tmp', jsonl_path)
+    return jsonl_path
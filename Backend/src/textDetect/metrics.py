@@ -0,0 +1,176 @@
+import bisect
+import glob
+import json
+import os
+import threading
+import time
+
+from textDetect import tracing
+
+# Upper bounds, in seconds, of the stage latency histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, counts, total, count):
+        self.counts = [a + b for a, b in zip(self.counts, counts)]
+        self.sum += total
+        self.count += count
+
+
+class MetricsRegistry:
+    """
+    In-process latency histograms, counters and gauges, rendered in the
+    Prometheus text format. Every traced stage (see tracing.stage) lands in
+    the tcgdex_stage_seconds histogram once the registry is installed.
+
+    Processes serving the same app (see serve.py) can share one view with
+    share(): each publishes its values to a directory and render() sums the
+    histograms and counters of all of them. Gauges show the largest value.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.counters = {}
+        self.gauges = {}
+        self.help = {}
+        # Set by share
+        self.directory = None
+        self.path = None
+
+    def install(self):
+        """ Starts recording every traced stage of this process. """
+        tracing.add_observer(self.observe_stage)
+        return self
+
+    def reset(self):
+        """ Drops the histograms and counters, e.g. the ones a forked worker inherited. Gauges are kept. """
+        with self.lock:
+            self.stages = {}
+            self.counters = {}
+
+    def share(self, directory, interval=1.0):
+        """
+        Publishes the values of this process to directory, every interval
+        seconds and on each render, and makes render() report the total over
+        every process publishing there. Files of processes that exited are
+        kept, so counters never go down.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.path = os.path.join(directory, f'metrics-{os.getpid()}.json')
+        self.publish()
+        threading.Thread(target=self.publish_every, args=(interval,), daemon=True).start()
+        return self
+
+    def publish_every(self, interval):
+        while True:
+            time.sleep(interval)
+            self.publish()
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'stages': {name: [h.counts, h.sum, h.count] for name, h in self.stages.items()},
+                'counters': [[name, labels, value] for (name, labels), value in self.counters.items()],
+                'gauges': [[name, labels, value] for (name, labels), value in self.gauges.items()],
+            }
+
+    def publish(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(self.snapshot(), file)
+        os.replace(tmp_path, self.path)
+
+    def shared_values(self):
+        # Sum of every published snapshot, in the shape of the live registry
+        self.publish()
+        stages, counters, gauges = {}, {}, {}
+        for path in glob.glob(os.path.join(self.directory, 'metrics-*.json')):
+            try:
+                with open(path) as file:
+                    snapshot = json.load(file)
+            except (OSError, ValueError):
+                continue
+            for name, (counts, total, count) in snapshot['stages'].items():
+                stages.setdefault(name, Histogram(self.buckets)).merge(counts, total, count)
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(tuple(label) for label in labels))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, value in snapshot['gauges']:
+                key = (name, tuple(tuple(label) for label in labels))
+                gauges[key] = max(gauges.get(key, value), value)
+        return stages, counters, gauges
+
+    def describe(self, name, help_text):
+        self.help[name] = help_text
+
+    def observe_stage(self, stage_name, seconds):
+        with self.lock:
+            if stage_name not in self.stages:
+                self.stages[stage_name] = Histogram(self.buckets)
+            self.stages[stage_name].observe(seconds)
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set_gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def render(self):
+        if self.directory:
+            stages, counters, gauges = self.shared_values()
+        else:
+            with self.lock:
+                stages, counters, gauges = dict(self.stages), dict(self.counters), dict(self.gauges)
+
+        lines = []
+        if stages:
+            lines.append('# HELP tcgdex_stage_seconds Time spent in each pipeline stage.')
+            lines.append('# TYPE tcgdex_stage_seconds histogram')
+            for stage_name, histogram in sorted(stages.items()):
+                cumulative = 0
+                for bound, count in zip(list(self.buckets) + ['+Inf'], histogram.counts):
+                    cumulative += count
+                    lines.append(f'tcgdex_stage_seconds_bucket{{stage="{stage_name}",le="{bound}"}} {cumulative}')
+                lines.append(f'tcgdex_stage_seconds_sum{{stage="{stage_name}"}} {histogram.sum}')
+                lines.append(f'tcgdex_stage_seconds_count{{stage="{stage_name}"}} {histogram.count}')
+
+        for metric_type, values in (('counter', counters), ('gauge', gauges)):
+            names = sorted({name for name, _ in values})
+            for name in names:
+                if name in self.help:
+                    lines.append(f'# HELP {name} {self.help[name]}')
+                lines.append(f'# TYPE {name} {metric_type}')
+                for (metric_name, labels), value in sorted(values.items()):
+                    if metric_name == name:
+                        lines.append(f'{name}{format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+# Process-wide registry, installed by the app
+registry = MetricsRegistry()
+registry.describe('tcgdex_identify_total', 'Identify requests by result.')
+registry.describe('tcgdex_model_load_seconds', 'Time it took to load each model or index.')
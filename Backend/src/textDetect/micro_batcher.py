@@ -0,0 +1,58 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent calls into batches. submit() hands an item to a
+    background thread and blocks until the batch it ended up in has been
+    processed. A batch is flushed once it holds max_batch items or max_wait
+    seconds after its first item arrived, whichever comes first.
+
+    process_batch takes a list of items and must return one result per item,
+    in the same order.
+    """
+
+    def __init__(self, process_batch, max_batch=8, max_wait=0.005, name='micro-batcher'):
+        self.process_batch = process_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def submit(self, item):
+        future = Future()
+        self.queue.put((item, future))
+        return future.result()
+
+    def next_batch(self):
+        # Wait for the first item, then give the others up to max_wait to join it
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                results = list(self.process_batch([item for item, _ in batch]))
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+            # A future left unresolved would block its caller forever
+            for _, future in batch[len(results):]:
+                future.set_exception(RuntimeError(f"process_batch returned {len(results)} results for {len(batch)} items"))
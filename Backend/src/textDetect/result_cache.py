@@ -0,0 +1,151 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from textDetect.metrics import registry
+
+registry.describe('tcgdex_result_cache_total', 'Result cache lookups by layer and outcome.')
+
+
+def content_key(data):
+    """ Cache key of the raw upload bytes. """
+    return 'sha256:' + hashlib.sha256(data).hexdigest()
+
+
+def perceptual_key(card_image, hash_size=16):
+    """
+    Cache key of a warped card that survives re-encoding and small lighting
+    changes: a difference hash of hash_size x hash_size bits.
+    """
+    gray = cv2.cvtColor(card_image, cv2.COLOR_BGR2GRAY) if len(card_image.shape) == 3 else card_image
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = small[:, 1:] > small[:, :-1]
+    return 'dhash:' + np.packbits(bits).tobytes().hex()
+
+
+def version_key(paths, *extra):
+    """
+    Short hash of what a cached result depends on: the size and modification
+    time of each of paths (missing ones included) and any extra values. It
+    changes when the catalog is recompiled or a model is retrained.
+    """
+    digest = hashlib.sha256()
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            digest.update(f'{path}:{stat.st_size}:{stat.st_mtime_ns}\n'.encode())
+        except FileNotFoundError:
+            digest.update(f'{path}:missing\n'.encode())
+    for value in extra:
+        digest.update(f'{value}\n'.encode())
+    return digest.hexdigest()[:16]
+
+
+class DiskCacheBackend:
+    """
+    Results shared by every process on the host through one SQLite file,
+    bounded to max_entries by evicting the least recently read.
+    """
+
+    def __init__(self, cache_dir, max_entries=100000, ttl=3600):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, 'results.sqlite')
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.local = threading.local()
+        self.puts = 0
+        with self.connection() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT NOT NULL, '
+                               'created REAL NOT NULL, accessed REAL NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)')
+
+    def connection(self):
+        # SQLite connections can't be shared between threads, so each thread opens its own
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self.local.connection = connection
+        return connection
+
+    def get(self, key):
+        now = time.time()
+        with self.connection() as connection:
+            row = connection.execute('SELECT value FROM results WHERE key = ? AND created > ?', (key, now - self.ttl)).fetchone()
+            if row is not None:
+                connection.execute('UPDATE results SET accessed = ? WHERE key = ?', (now, key))
+        return row[0] if row else None
+
+    def put(self, key, value):
+        now = time.time()
+        with self.connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO results (key, value, created, accessed) VALUES (?, ?, ?, ?)',
+                               (key, value, now, now))
+            self.puts += 1
+            # Trimming is a table scan, so only every so often
+            if self.puts % 100 == 0:
+                connection.execute('DELETE FROM results WHERE created <= ?', (now - self.ttl,))
+                connection.execute('DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+                                   (self.max_entries,))
+
+
+class ResultCache:
+    """
+    LRU cache of identify results with a time to live, in front of an
+    optional DiskCacheBackend. Values are stored as JSON, so every hit
+    returns a fresh copy. Keys are stored under version (see version_key), so
+    results of an older catalog or model are never served.
+    """
+
+    def __init__(self, max_entries=1024, ttl=3600, disk=None, version=''):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk = disk
+        self.version = version
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """ Returns (hit, value), value being None on a miss. The memory layer is checked before the disk. """
+        key = f'{self.version}:{key}'
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(key)
+                registry.increment('tcgdex_result_cache_total', layer='memory', result='hit')
+                return True, json.loads(entry[1])
+            if entry is not None:
+                del self.entries[key]
+        registry.increment('tcgdex_result_cache_total', layer='memory', result='miss')
+
+        if self.disk is not None:
+            value = self.disk.get(key)
+            registry.increment('tcgdex_result_cache_total', layer='disk', result='hit' if value is not None else 'miss')
+            if value is not None:
+                self.put_memory(key, value)
+                return True, json.loads(value)
+        return False, None
+
+    def put_memory(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def put(self, keys, value):
+        """ Stores value under each of keys. """
+        value = json.dumps(value)
+        for key in keys:
+            key = f'{self.version}:{key}'
+            self.put_memory(key, value)
+            if self.disk is not None:
+                self.disk.put(key, value)
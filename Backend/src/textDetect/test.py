@@ -9,9 +9,9 @@ from sklearn.metrics import classification_report
 downloader = ImageDownloader('/train.csv')
 preprocessor = ImagePreprocessor()
 
-images = downloader.load_dataset_images()
+downloaded = downloader.load_dataset_images()
 
 # Check the number of images downloaded
-print(f"Number of images downloaded: {len(images)}")
+print(f"Number of images downloaded: {downloaded}")
 
 
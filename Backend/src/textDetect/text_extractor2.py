@@ -2,23 +2,42 @@ import cv2
 import numpy as np
 from PIL import Image
 import pandas as pd
-import easyocr
-import matplotlib.pyplot as plt
+import threading
+import time
+from textDetect.constants import name_region_coords, hp_region_coords, move_region_coords
+from textDetect.tracing import stage
+from textDetect.metrics import registry
 
 class TextExtractor:
     
-    # Create a reader instance for EasyOCR
-    reader = easyocr.Reader(['en'], gpu=True)  # Set gpu=False if you don't have CUDA installed
+    # EasyOCR reader, created on first use so importing this module doesn't load any weights
+    reader = None
+    reader_lock = threading.Lock()
 
-    @staticmethod
-    def extract_text_with_easyocr_name(image):
-        # Ensure the image is in the right color format for EasyOCR
-        if len(image.shape) == 3 and image.shape[2] == 3:
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        
-        # Use EasyOCR to detect text with an allowlist of alphabets
-        results = TextExtractor.reader.readtext(image, allowlist='abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ')
+    @classmethod
+    def get_reader(cls):
+        if cls.reader is None:
+            with cls.reader_lock:
+                if cls.reader is None:
+                    import easyocr
+                    import torch
+                    start = time.perf_counter()
+                    # Fall back to CPU when CUDA isn't available
+                    cls.reader = easyocr.Reader(['en'], gpu=torch.cuda.is_available())
+                    registry.set_gauge('tcgdex_model_load_seconds', time.perf_counter() - start, model='ocr_reader')
+        return cls.reader
+
+    @classmethod
+    def warmup(cls):
+        """ Loads the reader and runs one blank image through it so the first request isn't slow. """
+        cls.get_reader().readtext(np.full((64, 256), 255, dtype=np.uint8))
 
+    # Characters each region is allowed to contain, None means no restriction
+    name_allowlist = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    number_allowlist = '0123456789'
+
+    @staticmethod
+    def select_name_text(results):
         # Filter results to include only those above the probability threshold
         high_prob_results = [result for result in results if result[2] >= 0.80]
 
@@ -29,13 +48,40 @@ class TextExtractor:
         else:
             # If no high probability results, sort all results by probability
             if results:
-                results.sort(key=lambda x: x[2], reverse=True)
+                results = sorted(results, key=lambda x: x[2], reverse=True)
                 text = results[0][1]  # Take the highest probability result
             else:
                 text = ""
 
         return text.strip()
 
+    @staticmethod
+    def select_moves_text(results):
+        # Concatenate the text from each detection
+        text = " ".join([result[1] for result in results])
+        return text.strip()
+
+    @staticmethod
+    def select_number_text(results):
+        # Select the result with the highest probability
+        results = sorted(results, key=lambda x: x[2], reverse=True)
+        if results:
+            highest_prob_result = results[0]
+            text = highest_prob_result[1]
+        else:
+            text = ""
+        return text.strip()
+
+    @staticmethod
+    def extract_text_with_easyocr_name(image):
+        # Ensure the image is in the right color format for EasyOCR
+        if len(image.shape) == 3 and image.shape[2] == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        
+        # Use EasyOCR to detect text with an allowlist of alphabets
+        results = TextExtractor.get_reader().readtext(image, allowlist=TextExtractor.name_allowlist)
+        return TextExtractor.select_name_text(results)
+
     @staticmethod
     def extract_text_with_easyocr_moves(image):
         # Ensure the image is in the right color format for EasyOCR
@@ -43,11 +89,8 @@ class TextExtractor:
             image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
         
         # Use EasyOCR to detect text
-        results = TextExtractor.reader.readtext(image)
-        
-        # Concatenate the text from each detection
-        text = " ".join([result[1] for result in results])
-        return text.strip()
+        results = TextExtractor.get_reader().readtext(image)
+        return TextExtractor.select_moves_text(results)
     
     @staticmethod
     def extract_text_with_easyocr_numbers(image):
@@ -56,17 +99,92 @@ class TextExtractor:
             image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
         
         # Use EasyOCR to detect text with an allowlist of numbers
-        results = TextExtractor.reader.readtext(image, allowlist='0123456789')
-        results.sort(key=lambda x: x[2], reverse=True)
-        
-        # Select the result with the highest probability
-        if results:
-            highest_prob_result = results[0]
-            text = highest_prob_result[1]
-        else:
-            text = ""
-        return text.strip()
-    
+        results = TextExtractor.get_reader().readtext(image, allowlist=TextExtractor.number_allowlist)
+        return TextExtractor.select_number_text(results)
+
+    @staticmethod
+    def boxes_in_region(horizontal_list, free_list, coords):
+        """
+        Picks the detected boxes whose centre lies inside coords (x1, y1, x2, y2).
+        Boxes are clipped to the region, like cropping it would, so none of
+        them reaches into a neighbouring card once the cards are stacked.
+        """
+        x1, y1, x2, y2 = coords
+        horizontal = []
+        for x_min, x_max, y_min, y_max in horizontal_list:
+            if x1 <= (x_min + x_max) / 2 < x2 and y1 <= (y_min + y_max) / 2 < y2:
+                horizontal.append([max(x_min, x1), min(x_max, x2), max(y_min, y1), min(y_max, y2)])
+        free = []
+        for box in free_list:
+            center_x, center_y = np.mean(box, axis=0)
+            if x1 <= center_x < x2 and y1 <= center_y < y2:
+                free.append([[min(max(x, x1), x2), min(max(y, y1), y2)] for x, y in box])
+        return horizontal, free
+
+    @staticmethod
+    def extract_text_from_card(card_image, scale_factor=1.5):
+        """
+        OCRs the name, HP and moves regions of a normalized card together.
+        Text detection runs once over the whole card; each detected box is
+        then recognized with the allowlist of the region it falls in.
+        Returns (name, hp, moves).
+        """
+        return TextExtractor.extract_text_from_cards([card_image], scale_factor)[0]
+
+    @staticmethod
+    def extract_text_from_cards(card_images, scale_factor=1.5):
+        """
+        Batched extract_text_from_card for several normalized cards. Detection
+        runs as one batch over all cards. For recognition the cards are stacked
+        into one tall image, so each region needs a single recognize call for
+        the whole batch. Returns a (name, hp, moves) tuple per card.
+        """
+        if not card_images:
+            return []
+
+        scaled_cards = []
+        for card_image in card_images:
+            gray = cv2.cvtColor(card_image, cv2.COLOR_BGR2GRAY) if len(card_image.shape) == 3 else card_image
+            scaled_cards.append(cv2.resize(gray, None, fx=scale_factor, fy=scale_factor, interpolation=cv2.INTER_LINEAR))
+        card_height = scaled_cards[0].shape[0]
+
+        # Every card has the same normalized size, so they can go through the detector as one batch
+        reader = TextExtractor.get_reader()
+        batch = np.stack([cv2.cvtColor(card, cv2.COLOR_GRAY2BGR) for card in scaled_cards])
+        with stage('ocr_detect'):
+            horizontal_lists, free_lists = reader.detect(batch, reformat=False)
+        stacked = np.vstack(scaled_cards)
+
+        regions = [
+            ('ocr_name', name_region_coords, TextExtractor.name_allowlist, TextExtractor.select_name_text),
+            ('ocr_hp', hp_region_coords, TextExtractor.number_allowlist, TextExtractor.select_number_text),
+            ('ocr_moves', move_region_coords, None, TextExtractor.select_moves_text),
+        ]
+        texts = [[] for _ in card_images]
+        for stage_name, coords, allowlist, select_text in regions:
+            scaled_coords = [int(round(c * scale_factor)) for c in coords]
+
+            # Shift each card's boxes down to where the card sits in the stacked image
+            horizontal, free = [], []
+            for i, (horizontal_list, free_list) in enumerate(zip(horizontal_lists, free_lists)):
+                card_horizontal, card_free = TextExtractor.boxes_in_region(horizontal_list, free_list, scaled_coords)
+                offset = i * card_height
+                horizontal.extend([x_min, x_max, y_min + offset, y_max + offset] for x_min, x_max, y_min, y_max in card_horizontal)
+                free.extend([[x, y + offset] for x, y in box] for box in card_free)
+
+            card_results = [[] for _ in card_images]
+            if horizontal or free:
+                with stage(stage_name):
+                    results = reader.recognize(stacked, horizontal_list=horizontal, free_list=free, allowlist=allowlist,
+                                               batch_size=len(horizontal) + len(free))
+                for result in results:
+                    # The card the box's vertical centre falls in
+                    center_y = np.mean([point[1] for point in result[0]])
+                    card_results[min(max(int(center_y // card_height), 0), len(card_images) - 1)].append(result)
+            for card_texts, results in zip(texts, card_results):
+                card_texts.append(select_text(results))
+        return [tuple(card_texts) for card_texts in texts]
+
     @staticmethod
     def extract_text_from_name(region):
         # Preprocess the region if necessary, e.g., resizing, thresholding
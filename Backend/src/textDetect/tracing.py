@@ -0,0 +1,51 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# Recorders active on each thread, see record_stages
+local = threading.local()
+
+# Callbacks given (stage, seconds) for every stage traced on any thread, see add_observer
+observers = []
+
+
+def add_observer(observer):
+    if observer not in observers:
+        observers.append(observer)
+
+
+@contextmanager
+def stage(name):
+    """
+    Times the enclosed block as pipeline stage `name`, adds the elapsed
+    seconds to every recorder active on this thread and passes them to the
+    observers. Costs next to nothing when there are neither.
+    """
+    recorders = getattr(local, 'recorders', None)
+    if not recorders and not observers:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        for timings in recorders or ():
+            timings[name] = timings.get(name, 0.0) + elapsed
+        for observer in observers:
+            observer(name, elapsed)
+
+
+@contextmanager
+def record_stages():
+    """
+    Collects the stages traced on this thread inside the block, as a
+    {stage: seconds} dict. A stage entered several times is summed.
+    """
+    timings = {}
+    recorders = local.__dict__.setdefault('recorders', [])
+    recorders.append(timings)
+    try:
+        yield timings
+    finally:
+        recorders.remove(timings)